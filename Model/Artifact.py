@@ -0,0 +1,35 @@
+import os
+import torch
+
+
+def save(path, **modules):
+    '''
+    writes the architecture spec and the state_dict of every module, e.g. save(path, model=segmentation_model), a module
+    needs get_spec and the class method from_spec to be rebuilt by build, the file is replaced rather than overwritten
+    since models loaded from it still map its pages
+    '''
+    torch.save({name: {'spec': module.get_spec(), 'state_dict': module.state_dict()} for name, module in modules.items()},
+               path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load(path):
+    '''
+    :return: name -> {'spec', 'state_dict'}, the tensors are memory mapped from path so they are only read when used
+    and every process loading the same file shares its pages
+    '''
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+
+def build(cls, stored, prepare=None):
+    '''
+    :param stored: one module of load
+    :param prepare: applied to the module before its weights are assigned, e.g. to remove buffers that weren't stored
+    :return: cls.from_spec(spec) holding the stored tensors themselves, no weights are initialized or copied
+    '''
+    with torch.device('meta'):
+        module = cls.from_spec(stored['spec'])
+        if prepare is not None:
+            prepare(module)
+    module.load_state_dict(stored['state_dict'], assign=True)
+    return module
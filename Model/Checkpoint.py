@@ -0,0 +1,92 @@
+import os
+import re
+import random
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(state):
+    '''
+    :return: state with every tensor copied to the host, training can keep updating the originals while it is written
+    '''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class Checkpointer():
+    def __init__(self, folder, keep=3):
+        '''
+        writes training checkpoints from a background thread, a checkpoint is written to a temporary file and renamed
+        so an interrupted write never replaces a complete one, only the keep most recent checkpoints are kept
+        '''
+        self.folder = folder
+        self.keep = keep
+        self.pattern = re.compile(r'checkpoint_(\d+)\.pt$')
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def get_file_name(self, epoch):
+        return 'checkpoint_{}.pt'.format(epoch)
+
+    def get_epochs(self):  # of the checkpoints on disk, oldest first
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(int(match.group(1)) for match in map(self.pattern.match, os.listdir(self.folder)) if match)
+
+    def save(self, state, epoch):
+        '''
+        copies state and returns, the copy is written while training continues, at most one write is in flight
+        :param epoch: checkpoints are ordered by it
+        '''
+        state = snapshot(state)
+        self.wait()
+        self.pending = self.writer.submit(self.write, state, epoch)
+
+    def write(self, state, epoch):
+        os.makedirs(self.folder, exist_ok=True)
+        path = join(self.folder, self.get_file_name(epoch))
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        for old_epoch in self.get_epochs()[:-self.keep]:
+            os.remove(join(self.folder, self.get_file_name(old_epoch)))
+
+    def wait(self):  # raises the error of a failed write
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def load_latest(self):
+        '''
+        :return: the most recent checkpoint, None if there is none
+        '''
+        self.wait()
+        epochs = self.get_epochs()
+        if not epochs:
+            return None
+        return torch.load(join(self.folder, self.get_file_name(epochs[-1])), map_location='cpu', weights_only=False)
+
+    def close(self):
+        self.wait()
+        self.writer.shutdown()
@@ -1,8 +1,10 @@
 import torch
 import os
+import sys
 from os.path import join
 import numpy as np
 import random
+import multiprocessing
 from enum import Enum
 
 
@@ -13,11 +15,18 @@ class DataSetNames(Enum):
 
 # pytorch
 #################################################################################################################
-use_cpu = False
-device = torch.device('cpu') if use_cpu else torch.device('cuda')
-dtype = torch.float32  # if use_cpu else torch.float32 #xentropy doesn't support float16
+use_cpu = not torch.cuda.is_available()
+local_rank = int(os.environ.get('LOCAL_RANK', 0))  # torchrun sets it, Distributed.setup for spawned ranks
+device = torch.device('cpu') if use_cpu else torch.device('cuda', local_rank)
+dtype = torch.float32  # parameters and losses stay float32, see mixed_precision
 args = {'device': device, 'dtype': dtype}
-torch.cuda.set_device(0)
+mixed_precision = False  # autocast forward passes to amp_dtype, e.g. on gpus or cpus with fast bfloat16
+amp_dtype = torch.bfloat16 if use_cpu else torch.float16  # float16 gradients are loss scaled
+if not use_cpu:
+    torch.cuda.set_device(local_rank)
+world_size = 1  # data parallel training processes, each trains on its own share of the training batches
+distributed_backend = 'gloo' if use_cpu else 'nccl'
+distributed_port = 29500
 #################################################################################################################
 
 #### experiments
@@ -27,13 +36,53 @@ model_size = 256
 encoding_size = 1024
 lr = .5
 dataset_name = DataSetNames.VOC
-experiment = 'FullSeg' + ('_Weights' if weights else '')
+experiment_name = 'FullSeg'
+experiment = experiment_name + ('_Weights' if weights else '')
 
 load_model = False
 downsample_ratio = 4
 encoding_downsample = 4
 batch_size = 10  # roughly 45 for 64 model_size and half as u keep doubling
+max_inference_batch = 64  # inference uses the largest power of two batch up to this that fits on the gpu
+tile_size = 512  # full resolution pixels per side of a tile of TiledInference
+tile_overlap = 64  # pixels neighbouring tiles share, their predictions are blended
+server_host = '127.0.0.1'
+server_port = 8080
+server_max_batch = 16  # requests the inference server coalesces into one batch
+server_latency_budget = .01  # seconds the first request of a batch waits for others to join it
 epochs = 10
+early_stopping_patience = 0  # validations without a better val accuracy before training stops, 0 never stops
+checkpoint_every = 0  # epochs between resumable checkpoints (0 for none), they restart the loader workers every epoch
+checkpoint_keep = 3  # most recent checkpoints kept on disk
+resume = '--resume' in sys.argv  # continue training from the experiment's latest checkpoint
+n_workers = os.cpu_count()  # processes used to decode and downsample files when building a dataset, 1 reads serially
+stream_build = True  # build datasets one downsampled sample at a time instead of holding both resolutions in memory
+memmap_build = True  # stream_build writes straight into the memory mapped store instead of an in memory array
+n_buckets = 4  # samples of each split are grouped into this many shape buckets, batches are cropped to their bucket
+loader_workers = 2  # background processes gathering training batches, 0 gathers them in the training loop
+prefetch_batches = 2  # batches each loader worker keeps ready
+pin_memory = not use_cpu  # page locked host batches so the copy to the gpu can run asynchronously
+augment = False  # random flips, scaling, crops and colour jitter of the training batches
+augment_on_device = False  # augment after the copy to the device instead of in the loader workers
+balanced_sampling = False  # oversample training images by their rare class area instead of (or with) weights
+balance_power = .5  # 0 samples uniformly, 1 weighs classes by their inverse pixel frequency
+#### meta learning
+meta_batch_size = 4  # episodes adapted at once, each with its own copy of the learner's parameters
+meta_support_size = 5  # support images per episode, sampled from the episode's k shots per label
+meta_inner_steps = 5  # meta optimizer steps on the support images before the query loss
+meta_bptt_window = 0  # inner steps backpropagated through per meta update, 0 unrolls all meta_inner_steps
+meta_checkpoint = False  # recompute inner forwards in the backward pass, trades compute for O(window) activations
+meta_decoder_only = False  # freeze the encoder (a trained Segmenter's if stored), cache its features, adapt the decoder
+meta_first_order = False  # every inner step is treated as the identity of the previous one when meta training
+meta_episode_store = False  # meta train on episodes materialized on disk, with fixed support images, read by shards
+episodes_per_shard = 64  # episodes per memory mapped file of the episode store
+feature_cache_size = 1024  # images whose encoder features stay on the device
+feature_cache_path = None  # folder evicted features are spilled to, None drops them
+feature_cache_dtype = torch.float16
+meta_model_size = 32
+meta_encoding_size = 64
+meta_lr = .001
+meta_epochs = 10
 np.random.seed(24)
 random.seed(24)
 torch.manual_seed(24)
@@ -43,17 +92,51 @@ torch.backends.cudnn.benchmark = False
 
 # Paths
 #################################################################################################################
-experiment_path = '..\\ExperimentResults\\' + dataset_name.value + '\\' + experiment + '\\' + str(
-    model_size) + '-' + str(encoding_size) + '\\'
-print(experiment_path)
 processed_data_path = '..\\Data\\ProcessedData\\'
-stored_model_path = join(experiment_path, 'model_' + str(lr))
-graph_file_path = join(experiment_path, 'heatmap_confusion_matrix' + str(lr))
-#################################################################################################################
+# worker processes (e.g. spawned to read files) re-import this module and must not truncate the console file
+is_main_process = multiprocessing.current_process().name == 'MainProcess'
+prnt = {}
+
+
+def set_paths(write_console=None):
+    '''
+    derives the experiment folder and file paths from the experiment settings above
+    :param write_console: truncate and log to this experiment's console file, by default only in the main process
+    '''
+    global experiment, experiment_path, stored_model_path, checkpoint_path, graph_file_path, console_file_name, \
+        console_file_path, prnt
+    experiment = experiment_name + ('_Weights' if weights else '')
+    experiment_path = '..\\ExperimentResults\\' + dataset_name.value + '\\' + experiment + '\\' + str(
+        model_size) + '-' + str(encoding_size) + '\\'
+    print(experiment_path)
+    stored_model_path = join(experiment_path, 'model_' + str(lr))
+    checkpoint_path = join(experiment_path, 'checkpoints_' + str(lr))
+    graph_file_path = join(experiment_path, 'heatmap_confusion_matrix' + str(lr))
+    if not os.path.exists(experiment_path):
+        os.makedirs(experiment_path)
+    console_file_name = 'console_' + str(lr) + '.txt'
+    console_file_path = join(experiment_path, console_file_name)
+    if 'file' in prnt:
+        prnt['file'].close()
+    write_console = is_main_process if write_console is None else write_console
+    mode = 'a' if resume else 'w'
+    prnt = {'file': open(console_file_path, mode), 'flush': True} if not load_model and write_console else {}
 
 
-if not os.path.exists(experiment_path):
-    os.makedirs(experiment_path)
-console_file_name = 'console_' + str(lr) + '.txt'
-console_file_path = join(experiment_path, console_file_name)
-prnt = {'file': open(console_file_path, 'w'), 'flush': True} if not load_model else {}
+def set_experiment(write_console=None, **settings):
+    '''
+    overrides module level settings, e.g. set_experiment(lr=.1, model_size=64), and recomputes the paths derived from
+    them, dataset_name may be given by value
+    '''
+    settings = dict(settings)
+    if isinstance(settings.get('dataset_name'), str):
+        settings['dataset_name'] = DataSetNames(settings['dataset_name'])
+    unknown = [name for name in settings if name not in globals()]
+    if unknown:
+        raise KeyError('unknown settings {}'.format(unknown))
+    globals().update(settings)
+    set_paths(write_console)
+
+
+set_paths()
+#################################################################################################################
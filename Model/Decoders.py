@@ -20,6 +20,9 @@ class SegDecoder(nn.Module):  # based on PPM
     def __init__(self, n_class, n_encoded_channels, out_shape,
                  scale_up=False, pool_scales=(2, 5, 8), size = 256):
         super(SegDecoder, self).__init__()
+        self.spec = {'n_class': n_class, 'n_encoded_channels': n_encoded_channels,
+                     'out_shape': [int(dim) for dim in out_shape], 'scale_up': scale_up,
+                     'pool_scales': list(pool_scales), 'size': size}
         self.scale_up = scale_up
         self.out_shape = out_shape
 
@@ -30,9 +33,9 @@ class SegDecoder(nn.Module):  # based on PPM
 
         bias=True
 
-        self.ppm = []
+        ppm = []
         for scale in pool_scales:
-            self.ppm.append(nn.Sequential(
+            ppm.append(nn.Sequential(
                 nn.AdaptiveAvgPool2d(scale),
                 nn.Conv2d(in_channels=n_encoded_channels,
                           out_channels=out_channels_1,
@@ -40,7 +43,7 @@ class SegDecoder(nn.Module):  # based on PPM
                 nn.BatchNorm2d(out_channels_1),
                 nn.ReLU(inplace=True),
             ))
-        self.l1 = nn.ModuleList(self.ppm)
+        self.l1 = nn.ModuleList(ppm)  # forward iterates l1, no plain list alias of the branches is kept
 
         l2_in_channels = n_encoded_channels + len(pool_scales)*out_channels_1
 
@@ -54,26 +57,26 @@ class SegDecoder(nn.Module):  # based on PPM
         )
 
 
-    def forward(self, encoded_features, segSize=None):
+    def forward(self, encoded_features, segSize=None, out_shape=None):
         '''
         :param encoded_features: first item is before fc with spatial integrity , second item is flattened conv features through fc
         :param segSize:
-        :return:
+        :param out_shape: overrides self.out_shape, e.g. for batches cropped to a shape bucket
+        :return: unnormalized class scores (logits), n x n_class x h x w
         '''
         input_size = encoded_features.size()
         ppm_out = [encoded_features]
-        for pool_scale in self.ppm:
+        for pool_scale in self.l1:
             ppm_out.append(F.interpolate(
                 pool_scale(encoded_features),
                 (input_size[2], input_size[3]),
                 mode='bilinear', align_corners=False))
         x = torch.cat(ppm_out, 1)
-        x = nn.functional.interpolate(x, self.out_shape)
+        x = nn.functional.interpolate(x, self.out_shape if out_shape is None else out_shape)
         x = self.l2(x)
 
         if self.scale_up:  # is True during inference
             x = nn.functional.interpolate(
                 x, size=segSize, mode='bilinear', align_corners=False)
-        x = nn.functional.softmax(x, dim=1)
         return x
 
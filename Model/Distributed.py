@@ -0,0 +1,168 @@
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import Model.Config as cfg
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_rank():  # the only rank that logs and writes files
+    return get_rank() == 0
+
+
+def setup(rank, world_size):
+    '''
+    joins the process group and points this process at its own device, only rank 0 keeps the console file
+    spawned ranks import Config before they get here, so their device is set as torchrun's LOCAL_RANK would have
+    '''
+    cfg.local_rank = rank % torch.cuda.device_count() if not cfg.use_cpu else 0
+    os.environ['LOCAL_RANK'] = str(cfg.local_rank)  # for anything this rank starts, e.g. loader workers
+    if not cfg.use_cpu:
+        torch.cuda.set_device(cfg.local_rank)
+        cfg.device = torch.device('cuda', cfg.local_rank)
+        cfg.args.update(device=cfg.device, dtype=cfg.dtype)
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', str(cfg.distributed_port))
+    dist.init_process_group(cfg.distributed_backend, rank=rank, world_size=world_size)
+    if rank == 0 and not cfg.load_model:
+        cfg.prnt = {'file': open(cfg.console_file_path, 'a'), 'flush': True}
+    else:
+        cfg.prnt = {'file': open(os.devnull, 'w')}
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def run(rank, world_size, fn, args):
+    setup(rank, world_size)
+    try:
+        fn(*args)
+    finally:
+        cleanup()
+
+
+def launch(fn, args=(), world_size=None):
+    '''
+    runs fn(*args) in world_size local processes of one process group, e.g. gloo on cpu processes
+    '''
+    world_size = cfg.world_size if world_size is None else world_size
+    mp.spawn(run, args=(world_size, fn, args), nprocs=world_size, join=True)
+
+
+def shared_seed():  # drawn by rank 0 so every rank shuffles the same way
+    seed = torch.empty((), dtype=torch.int64).random_().to(cfg.device)
+    if is_distributed():
+        dist.broadcast(seed, src=0)
+    return int(seed.item())
+
+
+def broadcast_flag(flag):  # rank 0's decision, e.g. to stop training early
+    if not is_distributed():
+        return flag
+    flag = torch.tensor(int(flag), device=cfg.device)
+    dist.broadcast(flag, src=0)
+    return bool(flag.item())
+
+
+def all_gather_object(value):  # one value per rank, in rank order
+    if not is_distributed():
+        return [value]
+    values = [None] * get_world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+
+def all_reduce_sum(value):
+    if not is_distributed():
+        return value
+    total = torch.tensor(float(value), dtype=torch.float64, device=cfg.device)
+    dist.all_reduce(total)
+    return total.item()
+
+
+class AllReduceSum(torch.autograd.Function):  # the gradient of a sum over the ranks is summed over the ranks too
+    @staticmethod
+    def forward(ctx, tensor):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+class DistributedBatchNorm2d(nn.BatchNorm2d):
+    '''
+    batch norm whose training statistics are all reduced over every rank (gloo on cpu, where nn.SyncBatchNorm is not
+    supported), ranks may hold different numbers of pixels
+    '''
+
+    def forward(self, input):
+        if not self.training or not is_distributed():
+            return super(DistributedBatchNorm2d, self).forward(input)
+        x = input.float()
+        n_channels = x.shape[1]
+        count = torch.full((1,), x.numel() / n_channels, dtype=x.dtype, device=x.device)
+        stats = AllReduceSum.apply(torch.cat((x.sum(dim=(0, 2, 3)), (x * x).sum(dim=(0, 2, 3)), count)))
+        n = stats[-1]
+        mean = stats[:n_channels] / n
+        var = torch.clamp(stats[n_channels:2 * n_channels] / n - mean * mean, min=0)
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                momentum = 1. / float(self.num_batches_tracked) if self.momentum is None else self.momentum
+                self.running_mean.mul_(1 - momentum).add_(mean.detach(), alpha=momentum)
+                self.running_var.mul_(1 - momentum).add_(var.detach() * n / torch.clamp(n - 1, min=1),
+                                                         alpha=momentum)
+        shape = (1, n_channels, 1, 1)
+        out = (x - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            out = out * self.weight.view(shape) + self.bias.view(shape)
+        return out.to(input.dtype)
+
+
+def convert_batch_norm(module):
+    '''
+    synchronizes every BatchNorm2d of module over the ranks, the parameters and buffers are kept so optimizers that
+    already hold them stay valid
+    '''
+    if not cfg.use_cpu:
+        return nn.SyncBatchNorm.convert_sync_batchnorm(module)
+    if isinstance(module, nn.BatchNorm2d) and not isinstance(module, DistributedBatchNorm2d):
+        converted = DistributedBatchNorm2d(module.num_features, module.eps, module.momentum, module.affine,
+                                           module.track_running_stats)
+        if module.affine:
+            converted.weight, converted.bias = module.weight, module.bias
+        converted.running_mean, converted.running_var = module.running_mean, module.running_var
+        converted.num_batches_tracked = module.num_batches_tracked
+        converted.train(module.training)
+        return converted
+    for name, child in module.named_children():
+        module.add_module(name, convert_batch_norm(child))
+    return module
+
+
+def wrap_model(model):
+    '''
+    :return: model wrapped in DistributedDataParallel, its gradients are all reduced during backward
+    '''
+    model = convert_batch_norm(model)
+    device_ids = None if cfg.use_cpu else [cfg.device.index]
+    return nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
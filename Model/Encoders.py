@@ -5,6 +5,8 @@ class SegEncoder(nn.Module): # will maintain same shape as input
     def __init__(self, in_shape, model_size=32, out_shape = 128,
                  dilation = 4, encoding_downsample=1):
         super(SegEncoder, self).__init__()
+        self.spec = {'in_shape': [int(dim) for dim in in_shape], 'model_size': model_size, 'out_shape': out_shape,
+                     'dilation': dilation, 'encoding_downsample': encoding_downsample}
 
         bias = True
         channels = in_shape[1] if len(in_shape) > 3 else 1
@@ -0,0 +1,192 @@
+import os
+import sys
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+import Model.Config as cfg
+from Model.SegmentationModel import load_model
+
+try:
+    import onnx
+    import onnxruntime
+except ImportError:  # the onnx export and runtime are optional, TorchScript needs nothing beyond torch
+    onnx = onnxruntime = None
+
+
+class ExportModel(nn.Module):  # logits at the input's resolution, the shape Segmenter trains with
+    def __init__(self, model):
+        super(ExportModel, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, out_shape=x.shape[-2:])
+
+
+def fold_batch_norm(module):
+    '''
+    :return: eval mode copy of module, every BatchNorm2d directly after a Conv2d of a Sequential is folded into the
+    convolution's weight and bias and replaced by an Identity
+    '''
+    module = copy.deepcopy(module).cpu().eval()
+    for sequential in [child for child in module.modules() if isinstance(child, nn.Sequential)]:
+        for i in range(len(sequential) - 1):
+            if isinstance(sequential[i], nn.Conv2d) and isinstance(sequential[i + 1], nn.BatchNorm2d):
+                sequential[i] = fuse_conv_bn_eval(sequential[i], sequential[i + 1])
+                sequential[i + 1] = nn.Identity()
+    return module
+
+
+def get_pooling_matrix(scale, length):  # the bins of adaptive_avg_pool2d, from floor(i * l / s) to ceil((i + 1) * l / s)
+    matrix = torch.zeros(scale, length)
+    for i in range(scale):
+        start, stop = i * length // scale, -(-(i + 1) * length // scale)
+        matrix[i, start:stop] = 1. / (stop - start)
+    return matrix
+
+
+class MatrixAvgPool2d(nn.Module):
+    def __init__(self, scale, height, width):
+        '''
+        adaptive average pooling of a height x width input as two matrix products, onnx only exports adaptive pooling
+        whose output size divides the input size
+        '''
+        super(MatrixAvgPool2d, self).__init__()
+        self.register_buffer('rows', get_pooling_matrix(scale, height))
+        self.register_buffer('columns', get_pooling_matrix(scale, width).t().contiguous())
+
+    def forward(self, x):
+        return self.rows @ x @ self.columns
+
+
+def fix_pooling(module, height, width):
+    '''
+    replaces every AdaptiveAvgPool2d of module's Sequentials by a MatrixAvgPool2d for height x width inputs
+    '''
+    for sequential in [child for child in module.modules() if isinstance(child, nn.Sequential)]:
+        for i, layer in enumerate(sequential):
+            if isinstance(layer, nn.AdaptiveAvgPool2d):
+                scale = layer.output_size if isinstance(layer.output_size, int) else layer.output_size[0]
+                sequential[i] = MatrixAvgPool2d(scale, height, width)
+    return module
+
+
+def export_torchscript(model, example, path):
+    '''
+    traces the folded model, the trace keeps the batch and image size dynamic
+    :param example: n x c x h x w cpu tensor
+    '''
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(ExportModel(fold_batch_norm(model)).eval(), example))
+    torch.jit.save(traced, path)
+
+
+def export_onnx(model, example, path):
+    '''
+    the batch size stays dynamic, the image size is example's since the pooling of the decoder is exported for the
+    encoder's output size
+    '''
+    if onnx is None:
+        raise ImportError('onnx and onnxruntime are needed to export {}'.format(path))
+    model = fold_batch_norm(model)
+    with torch.no_grad():
+        fix_pooling(model.decoder, *model.encoder(example).shape[-2:])
+        torch.onnx.export(ExportModel(model).eval(), (example,), path, input_names=['x'],
+                          output_names=['logits'], dynamic_axes={'x': {0: 'batch'}, 'logits': {0: 'batch'}},
+                          dynamo=False)
+    onnx.checker.check_model(onnx.load(path))
+
+
+class CpuRuntime():
+    def __init__(self, path, n_threads=None):
+        '''
+        runs an exported model on the cpu, a .onnx file with onnxruntime and a TorchScript file as the frozen graph, not
+        torch.jit.optimize_for_inference since its mkldnn pooling fails for pool scales that don't divide the input
+        '''
+        self.path = path
+        self.session = self.module = None
+        if path.endswith('.onnx'):
+            if onnxruntime is None:
+                raise ImportError('onnxruntime is needed to run {}'.format(path))
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if n_threads is not None:
+                options.intra_op_num_threads = n_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        else:
+            if n_threads is not None:
+                torch.set_num_threads(n_threads)
+            self.module = torch.jit.load(path, map_location='cpu')
+
+    def logits(self, x):
+        '''
+        :param x: n x c x h x w float32 array
+        :return: n x n_class x h x w tensor
+        '''
+        if self.session is not None:
+            return torch.from_numpy(self.session.run(None, {'x': x})[0])
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(x))
+
+    def predict(self, x):  # n x h x w labels
+        return self.logits(np.ascontiguousarray(x, dtype=np.float32)).argmax(dim=1).numpy()
+
+
+def time_call(fn, x, repeats):
+    fn(x)  # the first calls of a TorchScript graph profile and optimize it
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    return (time.perf_counter() - start) / repeats
+
+
+def verify(model, runtime, x, repeats=10, tolerance=1e-3):
+    '''
+    compares runtime with the eager model on the cpu, raises if the logits differ by more than tolerance relative to
+    their largest magnitude
+    :param x: n x c x h x w float32 array
+    :return: largest absolute logit difference, fraction of equal labels, speedup over the eager model
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    x_tensor = torch.from_numpy(x)
+
+    def eager(x):
+        with torch.inference_mode():
+            return model(x, out_shape=x.shape[-2:])
+
+    expected, actual = eager(x_tensor), runtime.logits(x)
+    difference = (expected - actual).abs().max().item()
+    agreement = (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean().item()
+    speedup = time_call(eager, x_tensor, repeats) / time_call(runtime.logits, x, repeats)
+    print('{}: max logit difference {:.2e}, {:.4%} equal labels, {:.2f}x the eager model'.format(
+        os.path.basename(runtime.path), difference, agreement, speedup))
+    if difference > tolerance * max(1., expected.abs().max().item()):
+        raise RuntimeError('{} differs from the eager model by {}'.format(runtime.path, difference))
+    return difference, agreement, speedup
+
+
+def main():
+    '''
+    python -m Model.Export [model path] exports a saved model (by default the experiment's) next to it as TorchScript
+    and, if onnx is installed, ONNX, then checks both against the eager model on batches of the training image shape
+    '''
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    path = paths[0] if paths else cfg.stored_model_path + '.pt'
+    model = load_model(path).cpu().eval()
+    _, in_channels, height, width = model.encoder.spec['in_shape']
+    x = np.random.default_rng(24).standard_normal((cfg.batch_size, in_channels, height, width)).astype(np.float32)
+    base_path = os.path.splitext(path)[0]
+    export_torchscript(model, torch.from_numpy(x), base_path + '.ts')
+    verify(model, CpuRuntime(base_path + '.ts'), x)
+    if onnx is None:
+        print('onnx and onnxruntime are not installed, skipping the onnx export')
+        return
+    export_onnx(model, torch.from_numpy(x), base_path + '.onnx')
+    verify(model, CpuRuntime(base_path + '.onnx'), x)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import torch
+import numpy as np
+import os
+from os.path import join
+from collections import OrderedDict
+import Model.Config as cfg
+import Model.Utilities as utils
+
+
+class FeatureCache():
+    def __init__(self, encoder, x, max_items=None, folder=None, dtype=None, batch_size=None):
+        '''
+        least recently used cache of a frozen encoder's features for the images of x, missing images are encoded in
+        batches and evicted features are either dropped or spilled to disk
+        :param x: n x c x h x w array the image indexes refer to, e.g. ProcessedDataSet.x
+        :param max_items: images whose features are kept on the device
+        :param folder: evicted features are written here and read back instead of being encoded again, None drops them
+        :param dtype: dtype the features are stored with, they are returned as cfg.dtype
+        '''
+        self.encoder = encoder
+        self.x = x
+        self.max_items = cfg.feature_cache_size if max_items is None else max_items
+        self.folder = cfg.feature_cache_path if folder is None else folder
+        self.dtype = cfg.feature_cache_dtype if dtype is None else dtype
+        self.batch_size = cfg.max_inference_batch if batch_size is None else batch_size
+        self.items = OrderedDict()  # image index -> features, least recently used first
+        self.on_disk = set()
+        self.hits = self.disk_hits = self.misses = 0
+        if self.folder is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            for file in os.listdir(self.folder):  # written by another encoder
+                if file.startswith('features_') and file.endswith('.npy'):
+                    os.remove(join(self.folder, file))
+
+    def get_file_name(self, index):
+        return 'features_{}.npy'.format(index)
+
+    def encode(self, indexes):
+        was_training = self.encoder.training
+        self.encoder.eval()
+        try:
+            with torch.inference_mode(), utils.autocast():
+                for start in range(0, len(indexes), self.batch_size):
+                    batch = indexes[start:start + self.batch_size]
+                    x_batch = torch.from_numpy(np.ascontiguousarray(self.x[batch])).to(non_blocking=True, **cfg.args)
+                    yield from zip(batch, self.encoder(x_batch).to(self.dtype))
+        finally:
+            self.encoder.train(was_training)
+
+    def get(self, indexes):
+        '''
+        :param indexes: image indexes of x, may repeat
+        :return: len(indexes) x encoder output tensor
+        '''
+        requested = {}
+        missing = []
+        for index in dict.fromkeys(int(index) for index in indexes):
+            if index in self.items:
+                self.items.move_to_end(index)
+                requested[index] = self.items[index]
+                self.hits += 1
+            elif index in self.on_disk:
+                requested[index] = torch.from_numpy(np.load(join(self.folder, self.get_file_name(index)))).to(
+                    cfg.device, self.dtype)
+                self.disk_hits += 1
+            else:
+                missing.append(index)
+        self.misses += len(missing)
+        requested.update(self.encode(missing))
+        features = torch.stack([requested[int(index)] for index in indexes]).to(cfg.dtype)
+        for index, feature in requested.items():
+            self.items[index] = feature
+            self.items.move_to_end(index)
+        self.evict()
+        return features
+
+    def evict(self):
+        while len(self.items) > self.max_items:
+            index, feature = self.items.popitem(last=False)
+            if self.folder is not None and index not in self.on_disk:
+                np.save(join(self.folder, self.get_file_name(index)), feature.float().cpu().numpy())
+                self.on_disk.add(index)
+
+    def report(self):
+        n = max(self.hits + self.disk_hits + self.misses, 1)
+        print('feature cache: {:.1%} hits, {:.1%} read from disk, {:.1%} encoded, {} images in memory'.format(
+            self.hits / n, self.disk_hits / n, self.misses / n, len(self.items)), **cfg.prnt)
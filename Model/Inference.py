@@ -0,0 +1,208 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+import Model.Config as cfg
+import Model.Utilities as utils
+
+
+class InferenceEngine():
+    def __init__(self, model, max_batch_size=None):
+        '''
+        batched inference that keeps the logits on the device and only copies the label maps back to the host
+        :param model: a SegmentationModel
+        :param max_batch_size: upper bound for the batch size, on gpu the largest power of two that fits is used
+        '''
+        self.model = model
+        self.max_batch_size = cfg.max_inference_batch if max_batch_size is None else max_batch_size
+        self.n_class = model.decoder.l2[-1].out_channels
+        self.label_dtype = np.uint8 if self.n_class < 255 else np.int32
+        self.fill_value = 255 if self.label_dtype == np.uint8 else -1  # pixels outside of a shape bucket
+        self.batch_sizes = {}  # per input shape
+
+    def to_device(self, x_batch):
+        return torch.from_numpy(np.ascontiguousarray(x_batch)).to(non_blocking=True, **cfg.args)
+
+    def predict_labels(self, x_batch, height, width):  # the contexts only cover the forward pass, not the consumer
+        with torch.inference_mode(), utils.autocast():
+            return self.model.predict_labels(self.to_device(x_batch[..., :height, :width]), out_shape=(height, width))
+
+    def get_batch_size(self, x, height, width):
+        '''
+        doubles the batch until it reaches max_batch_size or the device runs out of memory
+        '''
+        shape = (height, width)
+        if shape not in self.batch_sizes:
+            batch_size = min(self.max_batch_size, x.shape[0])
+            if cfg.device.type == 'cuda':
+                batch_size = 1
+                while batch_size * 2 <= min(self.max_batch_size, x.shape[0]):
+                    try:
+                        self.predict_labels(x[:batch_size * 2], height, width)
+                    except torch.cuda.OutOfMemoryError:
+                        torch.cuda.empty_cache()
+                        break
+                    batch_size *= 2
+            self.batch_sizes[shape] = max(batch_size, 1)
+        return self.batch_sizes[shape]
+
+    def iter_labels(self, x, buckets=None):
+        '''
+        :param x: n x c x h x w array, e.g. a memory mapped split of a ProcessedDataSet
+        :param buckets: shape buckets of x (see ProcessedDataSet.get_buckets), each batch is cropped to its bucket
+        :return: generator of (start, stop, label maps on the device) for consecutive batches
+        '''
+        if buckets is None:
+            buckets = [[0, x.shape[0]] + list(x.shape[-2:])]
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            for start, stop, height, width in buckets:
+                batch_size = self.get_batch_size(x[start:stop], height, width)
+                for i in range(start, stop, batch_size):
+                    batch_stop = min(i + batch_size, stop)
+                    labels = self.predict_labels(x[i:batch_stop], height, width)
+                    yield i, batch_stop, labels
+        finally:
+            self.model.train(was_training)
+
+    def predict(self, x, buckets=None, out=None):
+        '''
+        :param out: preallocated n x h x w array the label maps are written into
+        :return: out, pixels outside of a bucket are set to self.fill_value
+        '''
+        if out is None:
+            out = np.full((x.shape[0],) + tuple(x.shape[-2:]), self.fill_value, dtype=self.label_dtype)
+        label_dtype = torch.uint8 if self.label_dtype == np.uint8 else torch.int32
+        for start, stop, labels in self.iter_labels(x, buckets):
+            out[start:stop, :labels.shape[-2], :labels.shape[-1]] = labels.to(label_dtype).cpu().numpy()
+        return out
+
+    def evaluate(self, x, y, metrics: utils.ConfusionMatrix, buckets=None, shapes=None):
+        '''
+        accumulates the predictions for x into metrics on the device, no label maps are kept
+        :param shapes: n x 2 height and width of every image before padding (see ProcessedDataSet.get_sample_shapes),
+        only the pixels inside them are counted, None counts the whole bucket
+        '''
+        for start, stop, labels in self.iter_labels(x, buckets):
+            height, width = labels.shape[-2:]
+            valid = None if shapes is None else self.get_image_mask(shapes[start:stop], height, width)
+            metrics.update(labels, self.to_device_labels(y[start:stop, :height, :width]), valid)
+        return metrics
+
+    def get_image_mask(self, shapes, height, width):  # n x height x width, the top left of every sample is its image
+        shapes = torch.as_tensor(np.asarray(shapes)[:, :2], device=cfg.device).view(-1, 2, 1, 1)
+        rows = torch.arange(height, device=cfg.device).view(1, -1, 1)
+        columns = torch.arange(width, device=cfg.device).view(1, 1, -1)
+        return (rows < shapes[:, 0]) & (columns < shapes[:, 1])
+
+    def to_device_labels(self, y_batch):
+        return torch.from_numpy(np.ascontiguousarray(y_batch)).to(cfg.device, non_blocking=True)
+
+
+class TiledInference():
+    def __init__(self, model, tile_size=None, overlap=None, downsample_ratio=None, batch_size=None):
+        '''
+        full resolution label maps of images of any size, overlapping tiles are batched through the model at its
+        training resolution and their class probabilities are blended with weights that fall off towards the tile edges,
+        each pixel is labelled as soon as no later tile covers it, so apart from a batch of tiles only the blended
+        probabilities of the rows two rows of tiles share are held
+        :param model: a SegmentationModel
+        :param tile_size: tile height and width in full resolution pixels
+        :param overlap: pixels neighbouring tiles share
+        :param downsample_ratio: tiles are downsampled by it before the encoder, the decoder predicts at full resolution
+        '''
+        self.model = model
+        self.tile_size = cfg.tile_size if tile_size is None else tile_size
+        self.overlap = cfg.tile_overlap if overlap is None else overlap
+        if not 0 <= self.overlap < self.tile_size:
+            raise ValueError('overlap {} must be smaller than the tile size {}'.format(self.overlap, self.tile_size))
+        self.downsample_ratio = cfg.downsample_ratio if downsample_ratio is None else downsample_ratio
+        self.batch_size = cfg.max_inference_batch if batch_size is None else batch_size
+        self.n_class = model.decoder.l2[-1].out_channels
+        self.label_dtype = np.uint8 if self.n_class < 255 else np.int32
+        self.weights = {}  # per tile shape
+
+    def get_starts(self, length, tile):  # the last tile ends at the border instead of hanging over it
+        return list(range(0, length - tile, tile - self.overlap)) + [length - tile]
+
+    def get_weights(self, height, width):
+        '''
+        :return: height x width blending weights, 1 in the tile's centre and falling to 1 / (overlap / 2 + 1) at its edges
+        '''
+        if (height, width) not in self.weights:
+            ramp = self.overlap / 2 + 1
+
+            def profile(n):
+                i = torch.arange(n, device=cfg.device, dtype=torch.float32)
+                return torch.clamp(torch.minimum(i + 1, n - i) / ramp, max=1)
+
+            self.weights[(height, width)] = profile(height).view(-1, 1) * profile(width).view(1, -1)
+        return self.weights[(height, width)]
+
+    def predict_tiles(self, tiles):
+        '''
+        :param tiles: n x c x h x w array
+        :return: n x n_class x h x w weighted class probabilities
+        '''
+        x = torch.from_numpy(np.ascontiguousarray(tiles)).to(non_blocking=True, **cfg.args)
+        height, width = x.shape[-2:]
+        if self.downsample_ratio != 1:
+            x = F.interpolate(x, (max(1, height // self.downsample_ratio), max(1, width // self.downsample_ratio)),
+                              mode='bilinear', align_corners=False)
+        with utils.autocast():
+            logits = self.model(x, out_shape=(height, width))
+        return torch.softmax(logits.float(), dim=1) * self.get_weights(height, width)
+
+    def iter_tiles(self, image, row, tile_height, tile_width, columns):  # one row of tiles, left to right
+        for start in range(0, len(columns), self.batch_size):
+            yield from self.predict_tiles(np.stack([image[..., row:row + tile_height, column:column + tile_width]
+                                                    for column in columns[start:start + self.batch_size]]))
+
+    def predict_row(self, image, out, row, next_row, tile_height, tile_width, columns, above):
+        '''
+        adds to every tile what the tiles above and to its left left in its area and labels the part of it no later
+        tile covers
+        :param above: n_class x rows x width blended probabilities from the previous row of tiles, starting at row
+        :return: the blended probabilities from next_row to the bottom of this row of tiles
+        '''
+        width = image.shape[-1]
+        n_final = next_row - row
+        label_dtype = torch.uint8 if self.label_dtype == np.uint8 else torch.int32
+        below = torch.empty(self.n_class, row + tile_height - next_row, width, device=cfg.device)
+        left = None  # the previous tile's probabilities in this tile's columns
+        for i, (column, probs) in enumerate(zip(columns, self.iter_tiles(image, row, tile_height, tile_width, columns))):
+            next_column = columns[i + 1] if i + 1 < len(columns) else width
+            n_left = 0 if left is None else left.shape[-1]
+            if left is not None:
+                probs[:, :, :n_left] += left
+            if above is not None:
+                probs[:, :above.shape[1], n_left:] += above[:, :, column + n_left:column + tile_width]
+            n_done = next_column - column
+            out[row:next_row, column:next_column] = probs[:, :n_final, :n_done].argmax(dim=0).to(label_dtype).cpu().numpy()
+            below[:, :, column:next_column] = probs[:, n_final:, :n_done]
+            left = probs[:, :, n_done:]
+        return below
+
+    def predict(self, image, out=None):
+        '''
+        :param image: c x h x w array normalized as ProcessedDataSet.x, e.g. memory mapped, it is read a batch of tiles
+        at a time
+        :param out: preallocated h x w array the labels are written into, e.g. memory mapped
+        :return: out
+        '''
+        height, width = image.shape[-2:]
+        if out is None:
+            out = np.empty((height, width), dtype=self.label_dtype)
+        tile_height, tile_width = min(self.tile_size, height), min(self.tile_size, width)
+        rows, columns = self.get_starts(height, tile_height), self.get_starts(width, tile_width)
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            with torch.inference_mode():
+                above = None
+                for i, row in enumerate(rows):
+                    next_row = rows[i + 1] if i + 1 < len(rows) else height
+                    above = self.predict_row(image, out, row, next_row, tile_height, tile_width, columns, above)
+        finally:
+            self.model.train(was_training)
+        return out
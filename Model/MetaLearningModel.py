@@ -1,175 +1,387 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from torch.func import functional_call, grad_and_value, vmap, replace_all_batch_norm_modules_
+from torch.utils.checkpoint import checkpoint
 from os.path import join, isfile
 import data_processing.DataProcessor as dp
 import Model.SegmentationModel as seg
+import Model.Artifact as artifact
+from Model.FeatureCache import FeatureCache
 import numpy as np
 import Model.Config as cfg
+import Model.Utilities as utils
 import data_processing.KShotDataGenerator as kshot_dp
+import time
+import os
 
 
+def preprocess(x, p=10.):
+    '''
+    (log magnitude, sign) preprocessing of Andrychowicz et al., keeps coordinates of very different scales in a range
+    the lstm can work with
+    :return: x.shape + (2,)
+    '''
+    log = torch.clamp(torch.log(torch.abs(x) + 1e-30) / p, min=-1.)
+    sign = torch.clamp(x * np.exp(p), min=-1., max=1.)
+    return torch.stack((log, sign), dim=-1)
 
 
 class MetaLearningModel(nn.Module):
-    def __init__(self, input_size = 1):
+    def __init__(self, input_size=4, numHU=8):
+        '''
+        coordinate wise lstm optimizer (Ravi & Larochelle), every coordinate of the flattened parameters is a row of the
+        batch, the lstm reads its preprocessed gradient and loss and gates the update th_t = f_t * th_t1 - i_t * dL_t,
+        so i_t acts as a learning rate and f_t as weight decay, one step is the same few kernels for any number of
+        parameter tensors
+        '''
         super(MetaLearningModel, self).__init__()
-
-        numHU = 8
-        bias = False
         self.input_size = input_size
+        self.numHU = numHU
+        self.lstm = nn.LSTMCell(input_size=input_size, hidden_size=numHU)
+        self.wi = nn.Linear(in_features=numHU + 2, out_features=1)  # h_t, th_t1, i_t1
+        self.wf = nn.Linear(in_features=numHU + 2, out_features=1)  # h_t, th_t1, f_t1
+        # start close to sgd with a small learning rate that keeps the parameters
+        nn.init.uniform_(self.wf.bias, 4, 6)
+        nn.init.uniform_(self.wi.bias, -5, -4)
+
+    def get_spec(self):
+        return {'input_size': self.input_size, 'numHU': self.numHU}
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(**spec)
+
+    def initalize_states(self, n_coordinates):
+        '''
+        :return: n_coordinates x (2 * numHU + 2) buffer holding the lstm hidden and cell state, i_t1 and f_t1 of every
+        coordinate, f_t1 at 1 assumes nothing of the original parameters is forgotten
+        '''
+        states = torch.zeros(n_coordinates, 2 * self.numHU + 2, **cfg.args)
+        states[:, -1] = 1
+        return states
 
-        self.wi = nn.Linear(in_features=input_size, out_features=numHU, bias=bias)
-
-        self.wf = nn.Linear(in_features=input_size, out_features=numHU, bias=bias)
-
-
-        self.wg = nn.Linear(in_features=input_size, out_features=numHU, bias=bias)
-
-        self.wo = nn.Linear(in_features=input_size, out_features=numHU, bias=bias)
-
-
-        self.wxi = nn.Linear(in_features=input_size, out_features=numHU, bias=bias)
-        self.wxi = nn.Linear(in_features=input_size, out_features=numHU, bias=bias)
+    def split_states(self, states):  # views of the buffer, i_t1 and f_t1 are kept as one n_coordinates x 2 view
+        return states[:, :self.numHU], states[:, self.numHU:2 * self.numHU], states[:, -2:]
 
+    def forward(self, th_t1, dL_t, L_t, states):
+        '''
+        :param th_t1: parameter coordinates, flattened
+        :param dL_t: their gradients
+        :param L_t: the loss each coordinate's gradient was taken of
+        :param states: see initalize_states
+        :return: updated coordinates, states
+        '''
+        h_t1, c_t1, if_t1 = self.split_states(states)
+        x_t = torch.cat((preprocess(dL_t), preprocess(L_t)), dim=1)
+        h_t, c_t = self.lstm(x_t, (h_t1, c_t1))
+        # wi and wf applied at once without concatenating their inputs, their th_t1 and i_t1 / f_t1 columns are scales
+        weight = torch.cat((self.wi.weight, self.wf.weight))
+        th_t1 = th_t1.unsqueeze(1)
+        if_t = torch.sigmoid(torch.addmm(torch.cat((self.wi.bias, self.wf.bias)), h_t, weight[:, :self.numHU].t()) +
+                             th_t1 * weight[:, self.numHU] + if_t1 * weight[:, self.numHU + 1])
+        th_t = if_t[:, 1:] * th_t1 - if_t[:, :1] * dL_t.unsqueeze(1)
+        return th_t.squeeze(1), torch.cat((h_t, c_t, if_t), dim=1)
 
-    def forward(self, th_t1, dL_t, L_t):
-        x_t = torch.cat((dL_t, L_t, th_t1), dim=1)
-        i_t = torch.sigmoid(self.wi(torch.cat((x_t, self.i_t1), dim=1)))
-        f_t = torch.sigmoid(self.wf(torch.cat((x_t, self.f_t1), dim=1)))
 
-        xh = torch.cat((x_t, self.h_t1), dim=1) #todo try splitting so that it is wx (x) + wh (h) instead of wxh(w;h)
-        ci_t = torch.tanh(self.wg(xh))
-        o_t = torch.sigmoid(self.wo(xh))
-        c_t = torch.add(torch.dot(f_t, self.c_t1), torch.dot(i_t, ci_t))
-        h_t = torch.dot(o_t, torch.tanh(c_t))
-        print(h_t.shape)
-        self.h_t1 = h_t
-        self.i_t1 = i_t
-        self.f_t1 = f_t
-        self.c_t1 = c_t
+class MetaLearner():
+    def __init__(self, dataset: kshot_dp.KShotSegmentationDataGenerator, k=5, lr=None, decay=.00001,
+                 meta_batch_size=None, n_support=None, inner_steps=None, bptt_window=None, checkpoint_inner=None,
+                 decoder_only=None, first_order=None, encoder: seg.SegEncoder = None, episode_store=None):
+        '''
+        meta trains the lstm optimizer together with the learner's initial parameters on batches of episodes, every
+        episode gets its own copy of the parameters and all of them are adapted at once by vmapping functional calls
+        of a single learner over the stacked copies
+        :param meta_batch_size: episodes adapted at once
+        :param n_support: support images per episode
+        :param inner_steps: optimizer steps on the support images before the query loss
+        :param bptt_window: inner steps backpropagated through per meta update, 0 unrolls all of them
+        :param checkpoint_inner: recompute the learner's query forward and the meta optimizer steps during the backward
+        pass instead of keeping their activations
+        :param decoder_only: freeze the learner's encoder and adapt only its decoder on cached encoder features
+        :param first_order: ignore how each inner step depends on the previous ones, the initial parameters get the
+        gradient at the adapted parameters (as first order maml) and only the last step's graph is held
+        :param encoder: trained encoder the learner is built around when decoder_only
+        :param episode_store: meta train on the episodes materialized by the dataset's EpisodeStore
+        '''
+        self.k = k
+        self.lr = cfg.meta_lr if lr is None else lr
+        self.decay = decay
+        self.meta_batch_size = cfg.meta_batch_size if meta_batch_size is None else meta_batch_size
+        self.n_support = cfg.meta_support_size if n_support is None else n_support
+        self.inner_steps = cfg.meta_inner_steps if inner_steps is None else inner_steps
+        if self.inner_steps < 1:  # the query loss is taken after the inner steps, there is none without them
+            raise ValueError('inner_steps must be at least 1, got {}'.format(self.inner_steps))
+        self.bptt_window = cfg.meta_bptt_window if bptt_window is None else bptt_window
+        self.checkpoint_inner = cfg.meta_checkpoint if checkpoint_inner is None else checkpoint_inner
+        self.decoder_only = cfg.meta_decoder_only if decoder_only is None else decoder_only
+        self.first_order = cfg.meta_first_order if first_order is None else first_order
+        self.episode_store = cfg.meta_episode_store if episode_store is None else episode_store
+        self.model_folder = '..\\StoredModels\\'
+        self.model_name = 'MetaLearningModel.pt'
+        self.model_path = join(self.model_folder, self.model_name)
+        self.data = dataset
+        self.model = None  # the meta optimizer
+        self.learner = None  # its parameters are the initial parameters of every episode's learner
+        self.feature_cache = None
+        if not self.load_model():
+            self.build_model(encoder)
+        if self.decoder_only:
+            self.learner.encoder.requires_grad_(False)
+            self.feature_cache = FeatureCache(self.learner.encoder, self.data.dataset.x)
+        self.criterion = nn.CrossEntropyLoss(ignore_index=self.data.dataset.ignore_index)
+        self.opt = torch.optim.Adam(list(self.model.parameters()) + list(self.get_adapted().parameters()),
+                                    lr=self.lr, weight_decay=self.decay)
+
+    def build_model(self, encoder: seg.SegEncoder = None):
+        data = self.data.dataset
+        self.model = MetaLearningModel().to(**cfg.args)
+        self.learner = seg.SegmentationModel(in_shape=data.x_shape,
+                                             n_class=data.n_classes,
+                                             out_shape=data.y.shape[-2:],
+                                             size=cfg.meta_model_size,
+                                             encoding_size=cfg.meta_encoding_size).to(**cfg.args)
+        if encoder is None and self.decoder_only:
+            print('warning: meta training a decoder around a frozen, randomly initialized encoder', **cfg.prnt)
+        if encoder is not None:
+            self.learner.encoder = encoder.to(**cfg.args)
+            self.learner.decoder = seg.SegDecoder(n_class=data.n_classes, n_encoded_channels=encoder.out_shape,
+                                                  out_shape=data.y.shape[-2:], size=cfg.meta_model_size).to(**cfg.args)
+        self.prepare_learner(self.learner)
+
+    def prepare_learner(self, learner):
+        # running statistics can't be updated in place under vmap, a frozen encoder keeps its own and runs outside of it
+        replace_all_batch_norm_modules_(learner.decoder if self.decoder_only else learner)
+
+    def prepare_stored(self, learner, state_dict):
+        '''
+        removes the running statistics of the batch norms that were stored without them, the learner may have been
+        saved with another decoder_only
+        '''
+        for name, module in learner.named_modules():
+            if isinstance(module, nn.BatchNorm2d) and name + '.running_mean' not in state_dict:
+                replace_all_batch_norm_modules_(module)
 
-        self.lr_ = i_t
-        self.th_t1_c = f_t
-        self.dL_t = ci_t
-        self.th_t1 = self.c_t1
-        return h_t, i_t, f_t, c_t # i_t is learning rate, ci_t is -dL_t. c_t1= old parameters,
+    def get_adapted(self):  # the module whose parameters are adapted to every episode
+        return self.learner.decoder if self.decoder_only else self.learner
 
-    def update(self):
-        return torch.sum(torch.dot(self.th_t1_c, self.th_t1), torch.dot(self.lr_, self.dL_t))
+    def get_layout(self):  # names, shapes and sizes of the adapted parameters in flattened order
+        names, params = zip(*self.get_adapted().named_parameters())
+        return names, [param.shape for param in params], [param.numel() for param in params]
 
+    def flatten_params(self):
+        return torch.cat([param.reshape(-1) for param in self.get_adapted().parameters()])
 
-class MetaLearner():
-    def __init__(self, dataset:kshot_dp.KShotSegmentationDataGenerator, k = 5, lr = .01, decay = .00001):
-        self.k = 5
-        self.lr = lr
-        self.decay = decay
-        self.model_path = '..\\StoredModels\\'
-        self.model_name = 'MetaLearningModel.pk1'
-        self.model_path = join(self.model_path, self.model_name)
-        self.model = None
-        self.load_model()
-        self.data = dataset
+    def unflatten_params(self, flat_params):
+        '''
+        :param flat_params: ... x n_coordinates
+        :return: name -> view of flat_params with the parameter's shape
+        '''
+        names, shapes, sizes = self.get_layout()
+        return {name: param.view(flat_params.shape[:-1] + shape)
+                for name, shape, param in zip(names, shapes, torch.split(flat_params, sizes, dim=-1))}
 
     def load_model(self):
         if isfile(self.model_path):
-            self.model = torch.load(self.model_path)
+            stored = artifact.load(self.model_path)
+            self.model = artifact.build(MetaLearningModel, stored['model']).to(**cfg.args)
+            self.learner = artifact.build(seg.SegmentationModel, stored['learner'],
+                                          prepare=lambda learner: self.prepare_stored(
+                                              learner, stored['learner']['state_dict'])).to(**cfg.args)
+            self.prepare_learner(self.learner)
             return True
         return False
 
     def save_model(self):
-        torch.save(self.model, self.model_path)
-
-    def initalize_states(self, th_t1):  # initialize bias to be higher for forget gate i believe and lwoer for other
-        self.model.i_t1 = torch.ones(self.model.input_size)
-        self.model.f_t1 = torch.ones(
-            self.model.input_size)  # i believe this at 1 means assume we don't forget any of original paramter
-        self.model.c_t1 = th_t1
-        self.model.h_t1 = torch.zeros(self.model.input_size)  # shape like output of o_t, torch.tanh(c_t)
-        self.states_initialized = True
-        self.states = [(None, self.h_t1)]
-        # store states of LSTM, since one lstm is being trained for all of the hyper parameters,
-        # let's check this w paper though, and make sure there isnt' a better way...
-        # we can also make the batch size large enough so that pytorch does this storing for us, i believe
-
-    def get_optimizer(self, parameters):
-        if self.model is None:
-            self.train()
-        self.set_learner(parameters)
-        return self.model
-
-    def train(self):
-        n_train = 5
-        for i in range(0, n_train):
-            meta_x, meta_y = self.data.get_dataset(i)
-            self.meta_forward(meta_x, meta_y)
-
-
-    def meta_backward(self, criterion, y_out, y_targ, n_train):
-        loss = criterion.forward(input=y_out, target=y_targ)
-        for i in range(n_train):  # back prop through previous time steps
-            for j in range(5):
-                loss.backward(retain_graph=True)
-
-                if self.states[-j - 2][0] is None:
-                    print('wtf')
-                    break
-                self.states[-j - 2][0].grad.data.zero_()
-                curr_grad = self.states[-j - 1][0].grad
-                self.states[-j - 2][1].backward(curr_grad, retain_graph=True)
-
-    def meta_forward(self, meta_x, meta_y):
-        '''
-        Basically we are going to use x and y to give the meta learner its input paramters after every step
-        :param meta_x:
-        :param meta_y:
-        :return:
-        '''
-        unique = np.unique(meta_y[1])
-        learner = seg.SegmentationModel(np.expand_dims(meta_x[0][0], axis=0).shape, len(unique))
-        for learner_x, learner_y in meta_x:
-            opt_full = torch.optim.Adam(
-                list(learner.parameters()) + list(self.model.parameters()),
-                # consider taking out trainer params if we want to include more gradient info in updates
-                lr=self.lr, weight_decay=self.decay)
-            criterion = torch.nn.BCELoss()
-            criterion = self.train_learner(learner, opt_full, criterion, learner_x, learner_y)
-
-
-        meta_y_x = meta_y[0]
-        meta_y_y = meta_y[1]
-        Y_out = learner.forward(torch.Tensor(meta_y_x).to(**cfg.args))
-        loss = criterion(input=Y_out, target=torch.Tensor(meta_y_y).to(cfg.device).long())
-        loss.backward()
-        opt_full.step()
-        opt_full.zero_grad()
+        os.makedirs(self.model_folder, exist_ok=True)
+        artifact.save(self.model_path, model=self.model, learner=self.learner)
+
+    def get_buffers(self):
+        return {name: buffer for name, buffer in self.get_adapted().named_buffers()}
+
+    def task_loss(self, flat_params, buffers, x, y):  # one episode, n x c x h x w (or encoded) and n x h x w
+        y_out = functional_call(self.get_adapted(), (self.unflatten_params(flat_params), buffers), (x,),
+                                {'out_shape': y.shape[-2:]})
+        return self.criterion(y_out.float(), y)
 
+    def to_device(self, x_support, y_support, x_query, y_query):
+        return (torch.from_numpy(np.ascontiguousarray(x_support)).to(**cfg.args),
+                torch.from_numpy(np.asarray(y_support, dtype=np.int64)).to(cfg.device),
+                torch.from_numpy(np.ascontiguousarray(x_query)).to(**cfg.args),
+                torch.from_numpy(np.asarray(y_query, dtype=np.int64)).to(cfg.device))
 
-    def train_learner(self, learner, opt, criterion, x, y):
-        x, y = torch.Tensor(x).to(**cfg.args), torch.Tensor(y).to(cfg.device).long()
-        x, y = torch.unsqueeze(x, dim=0), torch.unsqueeze(y, dim=0)
-        Y_out = learner.forward(x)
-        loss = criterion(input=Y_out, target=y)
-        loss.backward(retain_graph=True)
-        opt.zero_grad()
+    def get_batch(self, episodes, rng: np.random.Generator = None):
+        '''
+        :return: support inputs, support labels, query inputs, query labels on the device, the inputs are the cached
+        encoder features of the images when decoder_only
+        '''
+        if not self.decoder_only:
+            return self.to_device(*self.data.get_episodes(episodes, self.n_support, rng))
+        support, query = self.data.get_episode_images(episodes, self.n_support, rng)
+        y = self.data.dataset.y
+        features = self.feature_cache.get(np.concatenate((support.ravel(), query.ravel())))
+        return (features[:support.size].view(support.shape + features.shape[1:]),
+                torch.from_numpy(np.asarray(y[support.ravel()], dtype=np.int64)).view(
+                    support.shape + y.shape[1:]).to(cfg.device),
+                features[support.size:].view(query.shape + features.shape[1:]),
+                torch.from_numpy(np.asarray(y[query.ravel()], dtype=np.int64)).view(
+                    query.shape + y.shape[1:]).to(cfg.device))
+
+    def get_store_batch(self, batch):
+        '''
+        :param batch: episodes read from an EpisodeStore, the query is the last image of every episode
+        :return: support inputs, support labels, query inputs, query labels on the device, see get_batch
+        '''
+        images = batch['images']
+        n_support = images.shape[1] - 1
+        y = batch['y'].to(cfg.device, non_blocking=True).long()
+        if self.decoder_only:
+            features = self.feature_cache.get(images.reshape(-1).numpy())
+            x = features.view(tuple(images.shape) + features.shape[1:])
+        else:
+            x = batch['x'].to(non_blocking=True, **cfg.args)
+        return x[:, :n_support], y[:, :n_support], x[:, n_support:], y[:, n_support:]
+
+    def get_store_loader(self):
+        '''
+        :return: the dataset's EpisodeStore and a loader over it, built once, its workers persist across epochs
+        '''
+        store = self.data.get_episode_store(self.n_support, self.meta_batch_size, read_x=not self.decoder_only)
+        loader = torch.utils.data.DataLoader(store,
+                                             batch_size=None,  # the store yields whole batches
+                                             num_workers=cfg.loader_workers,
+                                             prefetch_factor=cfg.prefetch_batches if cfg.loader_workers else None,
+                                             persistent_workers=cfg.loader_workers > 0,
+                                             pin_memory=cfg.pin_memory)
+        return store, loader
+
+    def iter_batches(self, epoch, rng: np.random.Generator, store_loader=None):
+        '''
+        :param store_loader: see get_store_loader, the episodes are read from the store if given
+        '''
+        if store_loader is not None:
+            store, loader = store_loader
+            store.set_epoch(epoch)
+            for batch in loader:
+                yield self.get_store_batch(batch)
+        else:
+            order = rng.permutation(self.data.get_episode_indexes())
+            for i in range(0, len(order), self.meta_batch_size):
+                yield self.get_batch(order[i:i + self.meta_batch_size], rng)
+
+    def train(self, epochs=None):
+        epochs = cfg.meta_epochs if epochs is None else epochs
+        rng = np.random.default_rng(self.data.seed)
+        store_loader = self.get_store_loader() if self.episode_store else None
+        for e in range(epochs):
+            mean_loss = 0
+            n_episodes = 0
+            start = time.perf_counter()
+            for batch in self.iter_batches(e, rng, store_loader):
+                loss = self.meta_forward(*batch)
+                mean_loss += loss.item() * batch[0].shape[0]
+                n_episodes += batch[0].shape[0]
+            elapsed = time.perf_counter() - start
+            print(' average query loss for meta epoch ', e, ': ', mean_loss / max(n_episodes, 1), **cfg.prnt)
+            print(' episodes per second: ', n_episodes / elapsed, **cfg.prnt)
+            if self.feature_cache is not None:
+                self.feature_cache.report()
+        self.save_model()
+
+    def meta_backward(self, loss):
+        self.opt.zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm_(list(self.model.parameters()) + list(self.learner.parameters()), .25)
+        self.opt.step()
 
-        for param in learner.parameters():
-            if not self.states_initialized:
-                self.initalize_states(param)
-            h_t, i_t, f_t, c_t = self.model.forward(th_t1=param, dL_t=param.grad, L_t=loss)
-            # ^ figuire out how to initialize values before first pass for this shit, in the paper
-            param.data = self.model.update().detach()
+    def meta_forward(self, x_support, y_support, x_query, y_query):
+        '''
+        adapts one copy of the learner per episode on its support images and meta trains on the query loss, with a
+        bptt_window the inner steps are unrolled window by window (truncated bptt): after each window the query loss is
+        backpropagated, the meta optimizer steps and the parameters and states are detached, so only one window of
+        graph is ever held
+        :param x_support: n_episodes x n_support x c x h x w, y_support n_episodes x n_support x h x w, same for query
+        :return: mean query loss after the last inner step
+        '''
+        window = self.bptt_window if self.bptt_window else self.inner_steps
+        initial_params, states = self.init_params(x_support.shape[0])
+        params = initial_params
+        for start in range(0, self.inner_steps, window):
+            for step in range(start, min(start + window, self.inner_steps)):
+                if self.first_order:  # the previous steps' graph is dropped, their updates pass gradients unchanged
+                    params = initial_params + (params - initial_params).detach()
+                    states = states.detach()
+                params, states = self.train_learner(params, states, x_support, y_support)
+            loss = self.query_loss(params, x_query, y_query)
+            self.meta_backward(loss)
+            params, states = params.detach(), states.detach()
+            initial_params, _ = self.init_params(x_support.shape[0])  # the meta optimizer stepped
+        return loss.detach()
+
+    def query_loss(self, params, x_query, y_query):
+        loss = vmap(self.task_loss, in_dims=(0, None, 0, 0))
+        if self.checkpoint_inner and torch.is_grad_enabled():
+            return checkpoint(loss, params, self.get_buffers(), x_query, y_query, use_reentrant=False).mean()
+        return loss(params, self.get_buffers(), x_query, y_query).mean()
+
+    def init_params(self, n_episodes):
+        '''
+        :return: the initial parameters for every episode (n_episodes x n_coordinates) and meta optimizer states
+        '''
+        params = self.flatten_params().unsqueeze(0).expand(n_episodes, -1)
+        return params, self.model.initalize_states(params.numel())
 
-    def set_learner(self, parameters):
-        self.parameters = parameters
+    def adapt(self, x_support, y_support):
+        '''
+        :return: per episode flattened parameters, n_episodes x n_coordinates
+        '''
+        params, states = self.init_params(x_support.shape[0])
+        for step in range(self.inner_steps):
+            params, states = self.train_learner(params, states, x_support, y_support)
+        return params
 
-    def step(self, loss):
-        for param in self.parameters:
-            weight_update = self.forward(param, param.grad.data, loss)
-            param.data = self.model.update().detach()
+    def train_learner(self, params, states, x, y):
+        '''
+        one meta optimizer step of every episode's learner, the gradients are inputs of the meta optimizer and are not
+        differentiated through (as in Ravi & Larochelle)
+        :param params: n_episodes x n_coordinates
+        :param states: meta optimizer states of every coordinate of every episode, see MetaLearningModel
+        :return: updated params and states
+        '''
+        grads, losses = vmap(grad_and_value(self.task_loss), in_dims=(0, None, 0, 0))(params.detach(),
+                                                                                        self.get_buffers(), x, y)
+        inputs = (params.reshape(-1), grads.reshape(-1), losses.unsqueeze(1).expand_as(params).reshape(-1), states)
+        if self.checkpoint_inner and torch.is_grad_enabled():
+            th_t, states = checkpoint(self.model.forward, *inputs, use_reentrant=False)
+        else:
+            th_t, states = self.model.forward(*inputs)
+        return th_t.view_as(params), states
+
+    def predict(self, params, x, out_shape):
+        '''
+        :param x: n_episodes x n x c x h x w (or encoded when decoder_only)
+        :return: n_episodes x n x out_shape label maps by every episode's adapted parameters
+        '''
+        with torch.no_grad():
+            y_out = vmap(lambda episode_params, episode_x: functional_call(
+                self.get_adapted(), (self.unflatten_params(episode_params), self.get_buffers()), (episode_x,),
+                {'out_shape': out_shape}))(params, x)
+        return y_out.argmax(dim=2)
 
-    def zero_grad(self):
-        pass
+    def test(self, episodes=None):
+        '''
+        adapts to the support images of every episode and evaluates the predictions for the queries
+        :param episodes: by default the held out episodes, whose queries are in the dataset's test range
+        :return: utils.ConfusionMatrix
+        '''
+        episodes = self.data.get_episode_indexes(test=True) if episodes is None else episodes
+        metrics = utils.ConfusionMatrix(self.learner.decoder.l2[-1].out_channels, self.data.dataset.ignore_index)
+        for i in range(0, len(episodes), self.meta_batch_size):
+            x_support, y_support, x_query, y_query = self.get_batch(episodes[i:i + self.meta_batch_size])
+            with torch.no_grad():  # the functional gradients of the adaptation are still taken
+                params = self.adapt(x_support, y_support)
+            metrics.update(self.predict(params, x_query, y_query.shape[-2:]), y_query)
+        print('meta test metrics ', metrics.summary(), **cfg.prnt)
+        return metrics
 
 
 def main():
@@ -177,11 +389,16 @@ def main():
     data.load_data()
     metadata = kshot_dp.KShotSegmentationDataGenerator(data, k=5)
     metadata.load_data()
-    model = MetaLearner(data)
-    if cfg.load_model:
-        model.load_model()
-    else:
+    encoder = None
+    segmenter_path = cfg.stored_model_path + '.pt'
+    if cfg.meta_decoder_only and isfile(segmenter_path):
+        encoder = artifact.build(seg.SegmentationModel, artifact.load(segmenter_path)['model']).encoder
+    elif cfg.meta_decoder_only:
+        print('no trained Segmenter at ', segmenter_path, **cfg.prnt)
+    model = MetaLearner(metadata, encoder=encoder)
+    if not cfg.load_model:
         model.train()
+    model.test(metadata.get_episode_indexes(test=True))
 
 
 if __name__ == "__main__":
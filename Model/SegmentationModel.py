@@ -2,8 +2,17 @@ from Model.Encoders import *
 from Model.Decoders import *
 import Model.Config as cfg
 import Model.Utilities as utils
+from Model.Inference import InferenceEngine, TiledInference
+import Model.Distributed as distributed
+import Model.Checkpoint as checkpoint
+import Model.Artifact as artifact
 from os.path import join, isfile
 import data_processing.DataProcessor as data
+from data_processing.Samplers import BucketBatchSampler, WeightedBucketBatchSampler
+from data_processing.BatchLoader import get_loader
+from data_processing.Augmentation import SegmentationAugmenter
+import time
+import copy
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -16,11 +25,28 @@ class SegmentationModel(nn.Module):
         self.decoder = SegDecoder(n_class=n_class, n_encoded_channels=self.encoder.out_shape,
                                   out_shape=out_shape, size=size)
 
-    def forward(self, input):
+    def forward(self, input, out_shape=None):
         encoded_features = self.encoder(input)
-        pred = self.decoder(encoded_features)
+        pred = self.decoder(encoded_features, out_shape=out_shape)
         return pred
 
+    def get_spec(self):  # the encoder's and decoder's constructor arguments, they may have been replaced
+        return {'encoder': self.encoder.spec, 'decoder': self.decoder.spec}
+
+    @classmethod
+    def from_spec(cls, spec):
+        model = cls.__new__(cls)
+        nn.Module.__init__(model)
+        model.encoder = SegEncoder(**spec['encoder'])
+        model.decoder = SegDecoder(**spec['decoder'])
+        return model
+
+    def predict_labels(self, input, out_shape=None):  # argmax of the logits, the softmax would not change it
+        return self.forward(input, out_shape=out_shape).argmax(dim=1)
+
+    def predict_proba(self, input, out_shape=None):
+        return nn.functional.softmax(self.forward(input, out_shape=out_shape), dim=1)
+
 
 class Segmenter():
     def __init__(self, model: SegmentationModel = None, downsample_ratio=2,
@@ -30,9 +56,13 @@ class Segmenter():
         self.encoding_size = encoding_size
         self.downsample_ratio = downsample_ratio
         self.lr = lr
-        self.model_path = cfg.stored_model_path + '.pkl'
+        self.model_path = cfg.stored_model_path + '.pt'
+        self.legacy_model_path = cfg.stored_model_path + '.pkl'  # a whole pickled model
         self.model = model
+        self.train_model = None  # self.model, wrapped in DistributedDataParallel when there are several ranks
         self.data = data
+        self.engine = None
+        self.history = []  # (epoch, val accuracy) of every validation during training
         if model is None:
             self.build_model()
 
@@ -50,75 +80,183 @@ class Segmenter():
             momentum=0.9,
             # weight_decay=.001
         )
-        self.criterion = nn.NLLLoss(ignore_index=self.data.ignore_index,
-                                    reduction='mean', weight=self.class_weights if cfg.weights else None)
+        self.scaler = utils.get_grad_scaler()
+        self.criterion = nn.CrossEntropyLoss(ignore_index=self.data.ignore_index,  # fused log_softmax and nll
+                                             reduction='mean', weight=self.class_weights if cfg.weights else None)
 
     def load_data(self):
         self.data.load_data()
         self.class_weights = torch.tensor(self.data.get_class_weights()).to(**cfg.args)
 
-    def train(self, epochs=10, batch_size=10, checkpoint_space=5):
+    def train(self, epochs=10, batch_size=10, checkpoint_space=5, patience=None, resume=None):
+        '''
+        :param checkpoint_space: epochs between validations
+        :param patience: validations without a better val accuracy before training stops and the best weights are
+        restored, 0 never stops
+        :param resume: continue after the latest checkpoint in cfg.checkpoint_path, epochs still counts from epoch 0
+        '''
+        patience = cfg.early_stopping_patience if patience is None else patience
+        resume = cfg.resume if resume is None else resume
+        best_accuracy, best_state, n_worse = -1, None, 0
         x_train, y_train = self.data.get_train_data()
         x_val, y_val = self.data.get_val_data()
+        train_buckets = self.data.get_buckets(self.data.train_range)
+        val_buckets = self.data.get_buckets(self.data.val_range)
+        train_shapes = self.data.get_sample_shapes(self.data.train_range)
+        val_shapes = self.data.get_sample_shapes(self.data.val_range)
         n_train = x_train.shape[0]
+        shard = {'seed': distributed.shared_seed(), 'rank': distributed.get_rank(),
+                 'world_size': distributed.get_world_size()}
+        if cfg.balanced_sampling:
+            sampler = WeightedBucketBatchSampler(
+                train_buckets, batch_size, self.data.get_sample_weights(self.data.train_range, cfg.balance_power),
+                **shard)
+        else:
+            sampler = BucketBatchSampler(train_buckets, batch_size, **shard)
+        checkpointer = checkpoint.Checkpointer(cfg.checkpoint_path, cfg.checkpoint_keep)
+        start_epoch = 0
+        state = checkpointer.load_latest() if resume else None
+        if state is not None:
+            start_epoch, best_accuracy, best_state, n_worse = self.load_checkpoint(state, sampler)
+            print('resuming after epoch ', start_epoch - 1, **cfg.prnt)
+        elif resume:
+            print('no checkpoint to resume from in ', cfg.checkpoint_path, **cfg.prnt)
+        if self.train_model is None:
+            self.train_model = distributed.wrap_model(self.model) if distributed.is_distributed() else self.model
+        augmenter = SegmentationAugmenter(self.data.ignore_index) if cfg.augment else None
+        # workers started every epoch draw their seeds from the checkpointed random state
+        loader = get_loader(self.data, self.data.train_range, sampler,
+                            augmenter=None if cfg.augment_on_device else augmenter,
+                            persistent_workers=not cfg.checkpoint_every)
         self.model.train()
         mean_loss = 0
-        for e in range(epochs):
-            shuffled_indexes = torch.randperm(n_train)
-            for i in range(0, n_train, batch_size):
-                indexes = shuffled_indexes[i:i + batch_size]
-                x_batch, y_batch = x_train[indexes], y_train[indexes]
-                x_batch, y_batch = torch.tensor(x_batch).to(**cfg.args), torch.tensor(y_batch).to(cfg.device).long()
-                y_out = self.model.forward(x_batch)
-                loss = self.criterion.forward(input=y_out, target=y_batch)
-                mean_loss += loss.data.item()
-                loss.backward(retain_graph=False)
-                self.opt.step()
-                self.opt.zero_grad()
-            print(' average loss for epoch ', e, ': ', mean_loss / n_train, **cfg.prnt)
-            if e % checkpoint_space == checkpoint_space - 1:
-                print('val accuracy ', self.pixel_accuracy(x_val, y_val, batch_size), **cfg.prnt)
-                print('train accuracy ', self.pixel_accuracy(x_train, y_train, batch_size), **cfg.prnt)
-            mean_loss = 0
+        try:
+            for e in range(start_epoch, epochs):
+                input_wait = 0
+                wait_start = time.perf_counter()
+                for x_batch, y_batch, shapes in loader:
+                    input_wait += time.perf_counter() - wait_start
+                    x_batch = x_batch.to(non_blocking=True, **cfg.args)
+                    y_batch = y_batch.to(cfg.device, non_blocking=True)
+                    if augmenter is not None and cfg.augment_on_device:
+                        x_batch, y_batch = augmenter(x_batch, y_batch, shapes.to(cfg.device, non_blocking=True))
+                    with utils.autocast():
+                        y_out = self.train_model(x_batch, out_shape=y_batch.shape[-2:])
+                    loss = self.criterion.forward(input=y_out.float(), target=y_batch)
+                    mean_loss += loss.data.item()
+                    self.scaler.scale(loss).backward(retain_graph=False)
+                    self.scaler.step(self.opt)
+                    self.scaler.update()
+                    self.opt.zero_grad()
+                    wait_start = time.perf_counter()
+                mean_loss = distributed.all_reduce_sum(mean_loss)
+                print(' average loss for epoch ', e, ': ', mean_loss / n_train, **cfg.prnt)
+                print(' average input wait per step (ms): ', 1000 * input_wait / max(len(loader), 1), **cfg.prnt)
+                stop = False
+                if e % checkpoint_space == checkpoint_space - 1 and distributed.is_main_rank():
+                    val_accuracy = float(self.evaluate(x_val, y_val, val_buckets, val_shapes).pixel_accuracy())
+                    self.history.append((e, val_accuracy))
+                    print('val accuracy ', val_accuracy, **cfg.prnt)
+                    print('train accuracy ',
+                          self.evaluate(x_train, y_train, train_buckets, train_shapes).pixel_accuracy(), **cfg.prnt)
+                    if val_accuracy > best_accuracy:
+                        best_accuracy, n_worse = val_accuracy, 0
+                        if patience:
+                            best_state = copy.deepcopy(self.model.state_dict())
+                    else:
+                        n_worse += 1
+                        stop = bool(patience) and n_worse >= patience
+                mean_loss = 0
+                if distributed.broadcast_flag(stop):
+                    print('stopping early after epoch ', e, **cfg.prnt)
+                    break
+                if cfg.checkpoint_every and (e + 1) % cfg.checkpoint_every == 0:
+                    state = self.get_checkpoint(e, sampler, (best_accuracy, best_state, n_worse))
+                    if distributed.is_main_rank():
+                        checkpointer.save(state, e)
+        finally:  # a failed epoch doesn't leave a checkpoint half written
+            checkpointer.close()
+        if best_state is not None:
+            self.model.load_state_dict(best_state)
         return self.model
 
-    def pixel_accuracy(self, x, y, batch_size):
-        predictions = self.predict(x, batch_size)
-        return utils.accuracy(predictions, y, self.data.ignore_index)
+    def get_checkpoint(self, epoch, sampler, early_stopping):
+        '''
+        :return: everything training needs to continue after epoch as if it never stopped, the random states of every
+        rank included
+        '''
+        return {'epoch': epoch,
+                'model': self.model.state_dict(),
+                'opt': self.opt.state_dict(),
+                'scaler': self.scaler.state_dict(),
+                'sampler': sampler.generator.get_state(),
+                'rng': distributed.all_gather_object(checkpoint.get_rng_state()),
+                'history': list(self.history),
+                'early_stopping': early_stopping}
 
-    def predict(self, x, batch_size=1):
-        self.model.eval()
-        predictions = []
-        for i in range(0, x.shape[0], batch_size):
-            x_batch = torch.tensor(x[i:i + batch_size]).to(**cfg.args)
-            prediction = self.model.forward(x_batch)
-            prediction = prediction.detach().cpu().numpy()
-            prediction = np.argmax(prediction, axis=1)
-            prediction = prediction
-            predictions.append(prediction)
-        predictions = np.concatenate(predictions, axis=0)
-        self.model.train()
-        return predictions
+    def load_checkpoint(self, state, sampler):
+        '''
+        :return: the epoch to continue with and the early stopping state (best val accuracy, best weights, validations
+        without improvement)
+        '''
+        self.model.load_state_dict(state['model'])
+        self.opt.load_state_dict(state['opt'])
+        if state['scaler']:  # empty when loss scaling is disabled
+            self.scaler.load_state_dict(state['scaler'])
+        sampler.generator.set_state(state['sampler'])
+        checkpoint.set_rng_state(state['rng'][distributed.get_rank() % len(state['rng'])])
+        self.history = list(state['history'])
+        return (state['epoch'] + 1,) + tuple(state['early_stopping'])
+
+    def evaluate(self, x, y, buckets=None, shapes=None):
+        '''
+        :param shapes: image shapes of x before padding, only their pixels are counted
+        :return: utils.ConfusionMatrix of the predictions for x, accumulated batch by batch
+        '''
+        engine = self.get_engine()
+        return engine.evaluate(x, y, utils.ConfusionMatrix(engine.n_class, self.data.ignore_index), buckets, shapes)
+
+    def get_engine(self):
+        if self.engine is None or self.engine.model is not self.model:
+            self.engine = InferenceEngine(self.model)
+        return self.engine
+
+    def predict_full_resolution(self, image, out=None):
+        '''
+        :param image: c x h x w full resolution image normalized as the training images, see TiledInference
+        :return: h x w label map
+        '''
+        return TiledInference(self.model).predict(image, out)
 
-    def test(self, batch_size):
+    def predict(self, x, buckets=None):
+        '''
+        :param buckets: shape buckets of x (see ProcessedDataSet.get_buckets), each batch is cropped to its bucket
+        :return: label maps, see InferenceEngine.predict
+        '''
+        return self.get_engine().predict(x, buckets)
+
+    def test(self):
         x_test, y_test = self.data.get_test_data()
-        y_pred_test = self.predict(x_test, batch_size)
-        print('test accuracy ', utils.accuracy(y_pred_test, y_test, self.data.ignore_index), **cfg.prnt)
+        test_metrics = self.evaluate(x_test, y_test, self.data.get_buckets(self.data.test_range),
+                                     self.data.get_sample_shapes(self.data.test_range))
+        print('test metrics ', test_metrics.summary(), **cfg.prnt)
 
         x_full, y_full = self.data.get_full_data()
-        y_pred_full = self.predict(x_full, batch_size)
-        print('accuracy for whole dataset', utils.accuracy(y_pred_full, y_full, self.data.ignore_index), **cfg.prnt)
+        full_range = range(0, self.data.n_samples)
+        full_metrics = self.evaluate(x_full, y_full, self.data.get_buckets(full_range),
+                                     self.data.get_sample_shapes(full_range))
+        print('metrics for whole dataset', full_metrics.summary(), **cfg.prnt)
 
-        utils.plot_confusion_matrix(y_pred_test, y_test, 'test')
-        utils.plot_confusion_matrix(y_pred_full, y_full, 'full')
+        utils.plot_matrix(test_metrics.get_matrix(), 'test')
+        utils.plot_matrix(full_metrics.get_matrix(), 'full')
 
     def show_predictions(self, x, y, idx):
         self.model.eval()
         _, ax = plt.subplots(1, 2)
         x_batch = torch.tensor(x[idx:idx + 1]).to(**cfg.args)
-        prediction = self.model.forward(x_batch)
+        with utils.autocast():
+            prediction = self.model.predict_labels(x_batch)
         prediction = prediction.detach().cpu().numpy()
-        prediction = np.argmax(prediction, axis=1)
         prediction = prediction[0]
         ground_truth = y[idx:idx + 1][0]
         ax[0].imshow(prediction)
@@ -127,18 +265,52 @@ class Segmenter():
         self.model.train()
 
     def save_model(self):
-        torch.save(self.model, self.model_path)
+        if distributed.is_main_rank():
+            artifact.save(self.model_path, model=self.model)
 
     def load_model(self):
+        '''
+        rebuilds the stored architecture around its memory mapped weights, on the cpu they are used without a copy
+        '''
         if isfile(self.model_path):
-            self.model = torch.load(self.model_path)
+            self.model = load_model(self.model_path)
+            return True
+        if isfile(self.legacy_model_path):
+            self.model = torch.load(self.legacy_model_path, weights_only=False)
             return True
         return False
 
 
+def load_model(path=None):
+    '''
+    :param path: a Segmenter's saved model, by default the experiment's
+    :return: the SegmentationModel built around the artifact's memory mapped weights
+    '''
+    path = cfg.stored_model_path + '.pt' if path is None else path
+    return artifact.build(SegmentationModel, artifact.load(path)['model']).to(**cfg.args)
+
+
+def train_distributed():
+    '''
+    runs in every rank, see distributed.launch
+    '''
+    dataset = data.get_experiment_data()(downsample_ratio=cfg.downsample_ratio)
+    segmenter = Segmenter(lr=cfg.lr, downsample_ratio=cfg.downsample_ratio, model_size=cfg.model_size,
+                          encoding_size=cfg.encoding_size, data=dataset)
+    segmenter.train(epochs=cfg.epochs, batch_size=cfg.batch_size)
+    segmenter.save_model()
+    if distributed.is_main_rank():
+        segmenter.test()
+
+
 def main(): #todo https://github.com/meetshah1995/pytorch-semseg
     print(cfg.lr, **cfg.prnt)
     dataset = data.get_experiment_data()(downsample_ratio=cfg.downsample_ratio)
+    if cfg.world_size > 1 and not cfg.load_model:
+        dataset.load_data()  # built once before the ranks load it
+        cfg.prnt['file'].close()  # rank 0 appends to the console file
+        distributed.launch(train_distributed)
+        return
     segmenter = Segmenter(lr=cfg.lr, downsample_ratio=cfg.downsample_ratio, model_size=cfg.model_size,
                           encoding_size=cfg.encoding_size, data=dataset)
     if cfg.load_model:
@@ -147,7 +319,7 @@ def main(): #todo https://github.com/meetshah1995/pytorch-semseg
         segmenter.train(epochs=cfg.epochs, batch_size=cfg.batch_size)
         segmenter.save_model()
 
-        segmenter.test(cfg.batch_size)
+        segmenter.test()
     x, y = segmenter.data.get_train_data()
     segmenter.show_predictions(x, y, 1)
     x, y = segmenter.data.get_test_data()
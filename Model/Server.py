@@ -0,0 +1,288 @@
+import asyncio
+import io
+import sys
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import Model.Config as cfg
+import Model.Utilities as utils
+from Model.SegmentationModel import load_model
+
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def from_npy(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class Batcher():
+    def __init__(self, model, max_batch_size=None, latency_budget=None, pad_value=-1., window=10000):
+        '''
+        coalesces concurrent single image requests into batches, a batch runs once it is full or its first image has
+        waited latency_budget seconds, images of different shapes are padded to the largest of their batch
+        :param model: a SegmentationModel
+        :param pad_value: -1 is the padding of ProcessedDataSet after it normalizes the input
+        :param window: most recent requests the statistics are taken over
+        '''
+        self.model = model.eval()
+        self.max_batch_size = cfg.server_max_batch if max_batch_size is None else max_batch_size
+        self.latency_budget = cfg.server_latency_budget if latency_budget is None else latency_budget
+        self.pad_value = pad_value
+        self.n_class = model.decoder.l2[-1].out_channels
+        self.in_channels = model.encoder.spec['in_shape'][1]
+        self.label_dtype = torch.uint8 if self.n_class < 255 else torch.int32
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)  # batches run off the event loop, one at a time
+        self.latencies = deque(maxlen=window)  # seconds from a request's arrival to its label map
+        self.finish_times = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests = 0
+
+    async def predict(self, image):
+        '''
+        :param image: c x h x w array normalized as ProcessedDataSet.x
+        :return: h x w label map
+        '''
+        # checked before queueing, a bad image would fail every request batched with it
+        if image.ndim != 3 or image.shape[0] != self.in_channels or min(image.shape) < 1:
+            raise ValueError('expected a {} x h x w image, got shape {}'.format(self.in_channels, image.shape))
+        if not np.issubdtype(image.dtype, np.floating):
+            raise ValueError('expected a float image, got dtype {}'.format(image.dtype))
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((time.perf_counter(), image, future))
+        return await future
+
+    async def get_batch(self):
+        requests = [await self.queue.get()]
+        deadline = requests[0][0] + self.latency_budget
+        while len(requests) < self.max_batch_size:
+            if not self.queue.empty():  # arrived while the previous batch ran
+                requests.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.get_batch()
+            try:
+                labels = await loop.run_in_executor(self.executor, self.predict_batch,
+                                                    [image for _, image, _ in requests])
+            except Exception as e:  # fails this batch's requests, not the server
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finish_time = time.perf_counter()
+            for (arrival, _, future), label in zip(requests, labels):
+                if not future.done():
+                    future.set_result(label)
+                self.latencies.append(finish_time - arrival)
+                self.finish_times.append(finish_time)
+            self.batch_sizes.append(len(requests))
+            self.n_requests += len(requests)
+
+    def predict_batch(self, images):
+        height = max(image.shape[-2] for image in images)
+        width = max(image.shape[-1] for image in images)
+        x = np.full((len(images), images[0].shape[0], height, width), self.pad_value, dtype=np.float32)
+        for i, image in enumerate(images):
+            x[i, :, :image.shape[-2], :image.shape[-1]] = image
+        with torch.inference_mode(), utils.autocast():
+            labels = self.model.predict_labels(torch.from_numpy(x).to(non_blocking=True, **cfg.args),
+                                               out_shape=(height, width))
+        labels = labels.to(self.label_dtype).cpu().numpy()  # only the label maps leave the device
+        return [label[:image.shape[-2], :image.shape[-1]] for label, image in zip(labels, images)]
+
+    def stats(self):
+        '''
+        :return: throughput and latency percentiles over the most recent requests
+        '''
+        stats = {'requests': self.n_requests, 'queued': self.queue.qsize()}
+        if len(self.finish_times) > 1:
+            latencies = 1000 * np.array(self.latencies)
+            stats.update({'throughput (images/s)': (len(self.finish_times) - 1) /
+                                                   max(self.finish_times[-1] - self.finish_times[0], 1e-9),
+                          'latency p50 (ms)': float(np.percentile(latencies, 50)),
+                          'latency p90 (ms)': float(np.percentile(latencies, 90)),
+                          'latency p99 (ms)': float(np.percentile(latencies, 99)),
+                          'mean batch size': float(np.mean(self.batch_sizes))})
+        return stats
+
+
+class Server():
+    def __init__(self, model, host=None, port=None, path=None, **batcher_args):
+        '''
+        http inference server on host:port, or on the unix socket path if given
+        POST /predict with an .npy c x h x w image body answers with the .npy label map
+        GET /stats answers with Batcher.stats as json, GET /health with ok
+        '''
+        self.model = model
+        self.host = cfg.server_host if host is None else host
+        self.port = cfg.server_port if port is None else port
+        self.path = path
+        self.batcher_args = batcher_args
+        self.batcher = None
+        self.server = None
+        self.connections = set()  # handler tasks of the open connections
+
+    async def start(self):
+        self.batcher = Batcher(self.model, **self.batcher_args)
+        self.batcher_task = asyncio.get_running_loop().create_task(self.batcher.run())
+        if self.path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        print('serving on ', self.path or '{}:{}'.format(self.host, self.port))
+
+    async def serve(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self, timeout=1.):  # connections still open after timeout seconds are cancelled
+        self.server.close()
+        if self.connections:
+            _, pending = await asyncio.wait(self.connections, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await self.server.wait_closed()
+        self.batcher_task.cancel()
+
+    async def handle(self, reader, writer):  # one connection, requests are answered in order while it is kept alive
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = request_line.split(' ', 2)
+                headers = dict(line.split(':', 1) for line in header_lines if ':' in line)
+                headers = {name.strip().lower(): value.strip() for name, value in headers.items()}
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content_type, response = await self.route(method, target, body)
+                writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, content_type, len(response)).encode('latin-1') + response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def route(self, method, target, body):
+        try:
+            if method == 'POST' and target == '/predict':
+                labels = await self.batcher.predict(from_npy(body))
+                return '200 OK', 'application/octet-stream', to_npy(labels)
+            if method == 'GET' and target == '/stats':
+                return '200 OK', 'application/json', json.dumps(self.batcher.stats()).encode()
+            if method == 'GET' and target == '/health':
+                return '200 OK', 'text/plain', b'ok'
+            return '404 Not Found', 'text/plain', b'not found'
+        except ValueError as e:  # also a body that isn't an .npy array
+            return '400 Bad Request', 'text/plain', str(e).encode()
+        except Exception as e:
+            return '500 Internal Server Error', 'text/plain', repr(e).encode()
+
+
+async def open_connection(host=None, port=None, path=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(cfg.server_host if host is None else host,
+                                         cfg.server_port if port is None else port)
+
+
+async def request(reader, writer, method, target, body=b''):
+    '''
+    :return: the response body of one request on a kept alive connection
+    '''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(
+        method, target, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    status = head.split(' ', 2)[1]
+    length = next(int(line.split(':', 1)[1]) for line in head.split('\r\n') if line.lower().startswith('content-length'))
+    response = await reader.readexactly(length)
+    if status != '200':
+        raise RuntimeError('{} {}'.format(status, response.decode(errors='replace')))
+    return response
+
+
+async def benchmark(image, n_requests=256, concurrency=16, host=None, port=None, path=None):
+    '''
+    concurrency connections send single image requests back to back
+    :return: the client side latencies in seconds and the server's stats
+    '''
+    body = to_npy(image)
+    latencies = []
+
+    async def client(n):
+        reader, writer = await open_connection(host, port, path)
+        for _ in range(n):
+            start = time.perf_counter()
+            from_npy(await request(reader, writer, 'POST', '/predict', body))
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n_requests // concurrency + (i < n_requests % concurrency))
+                           for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    reader, writer = await open_connection(host, port, path)
+    stats = json.loads(await request(reader, writer, 'GET', '/stats'))
+    writer.close()
+    await writer.wait_closed()
+    latencies = 1000 * np.array(latencies)
+    print('client: {:.1f} images/s, latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+        len(latencies) / elapsed, *np.percentile(latencies, [50, 90, 99])))
+    print('server: ', stats)
+    return latencies / 1000, stats
+
+
+async def serve_and_benchmark(model, n_requests=256, concurrency=16, **batcher_args):
+    '''
+    benchmarks a server on a free localhost port with random images of the model's training shape
+    '''
+    server = Server(model, port=0, **batcher_args)
+    await server.start()
+    _, in_channels, height, width = model.encoder.spec['in_shape']
+    image = np.random.default_rng(24).standard_normal((in_channels, height, width)).astype(np.float32)
+    try:
+        return await benchmark(image, n_requests, concurrency, port=server.server.sockets[0].getsockname()[1])
+    finally:
+        await server.close()
+
+
+def main():
+    '''
+    python -m Model.Server [model path] serves the experiment's saved model, with --benchmark it sends it requests of
+    the training image shape on localhost instead and prints the throughput and latency percentiles
+    '''
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    model = load_model(paths[0] if paths else None)
+    if '--benchmark' in sys.argv:
+        asyncio.run(serve_and_benchmark(model))
+    else:
+        asyncio.run(Server(model).serve())
+
+
+if __name__ == '__main__':
+    main()
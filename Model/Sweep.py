@@ -0,0 +1,190 @@
+import os
+import sys
+import csv
+import json
+import time
+import itertools
+import multiprocessing
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+import Model.Config as cfg
+
+
+def get_trials(space, search='grid', n_trials=None, seed=24):
+    '''
+    :param space: setting name -> list of values, for a random search a (low, high) tuple is sampled log uniformly
+    :param search: 'grid' for every combination of the lists, 'random' for n_trials random draws
+    :return: list of settings dicts
+    '''
+    if search == 'grid':
+        names = list(space)
+        return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if search != 'random':
+        raise ValueError('unknown search {}'.format(search))
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(n_trials):
+        trial = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                trial[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            else:
+                trial[name] = values[rng.integers(len(values))]
+        trials.append(trial)
+    return trials
+
+
+def get_result_key(settings):  # the settings that determine a trial's folder and file names
+    dataset_name = settings.get('dataset_name', cfg.dataset_name)
+    return (getattr(dataset_name, 'value', dataset_name), settings.get('weights', cfg.weights),
+            settings.get('experiment_name', cfg.experiment_name), settings.get('model_size', cfg.model_size),
+            settings.get('encoding_size', cfg.encoding_size), settings.get('lr', cfg.lr))
+
+
+def run_trial(trial_id, settings, epochs, patience, n_threads):
+    '''
+    trains and tests one Segmenter in a fresh process, Config is set up for the trial before anything reads it
+    '''
+    import data_processing.DataProcessor as data
+    import Model.SegmentationModel as seg
+    torch.set_num_threads(n_threads)
+    cfg.set_experiment(write_console=True, **settings)
+    start = time.perf_counter()
+    dataset = data.get_experiment_data()(downsample_ratio=cfg.downsample_ratio)
+    segmenter = seg.Segmenter(lr=cfg.lr, downsample_ratio=cfg.downsample_ratio, model_size=cfg.model_size,
+                              encoding_size=cfg.encoding_size, data=dataset)
+    segmenter.train(epochs=epochs, batch_size=cfg.batch_size, checkpoint_space=1, patience=patience)
+    segmenter.save_model()
+    x_test, y_test = dataset.get_test_data()
+    test_metrics = segmenter.evaluate(x_test, y_test, dataset.get_buckets(dataset.test_range),
+                                      dataset.get_sample_shapes(dataset.test_range))
+    print('test metrics ', test_metrics.summary(), **cfg.prnt)
+    best_epoch, best_accuracy = max(segmenter.history, key=lambda h: h[1], default=(-1, float('nan')))
+    result = {'trial': trial_id}
+    result.update({name: getattr(value, 'value', value) for name, value in settings.items()})
+    result.update({'best val accuracy': best_accuracy,
+                   'best epoch': best_epoch,
+                   'epochs run': segmenter.history[-1][0] + 1 if segmenter.history else 0,
+                   'test pixel accuracy': float(test_metrics.pixel_accuracy()),
+                   'test mean iou': float(test_metrics.mean_iou()),
+                   'seconds': time.perf_counter() - start,
+                   'experiment path': cfg.experiment_path})
+    return result
+
+
+class Sweep():
+    def __init__(self, space, search='grid', n_trials=None, n_parallel=2, epochs=None, patience=2, name='sweep',
+                 seed=24):
+        '''
+        runs a Segmenter trial per setting of space in a pool of processes, every trial memory maps the same processed
+        dataset (built once up front) and writes into its own ExperimentResults/<dataset>/<experiment>/<size> folder
+        :param space: see get_trials, any module level setting of Config can be swept
+        :param n_parallel: trials run at once, the cpu threads are split between them
+        :param patience: validations (one per epoch) without a better val accuracy before a trial stops
+        '''
+        self.trials = get_trials(space, search, n_trials, seed)
+        self.n_parallel = n_parallel
+        self.epochs = cfg.epochs if epochs is None else epochs
+        self.patience = patience
+        self.name = name
+        self.results = []
+        self.assign_experiments()
+
+    def assign_experiments(self):
+        '''
+        trials that would share a folder and file names (they only differ in settings that aren't part of the paths)
+        get their trial number appended to the experiment name
+        '''
+        seen = set()
+        for i, trial in enumerate(self.trials):
+            key = get_result_key(trial)
+            if key in seen:
+                trial['experiment_name'] = '{}_trial{}'.format(key[2], i)
+            seen.add(get_result_key(trial))
+
+    def build_datasets(self):
+        '''
+        completes every store before the trials start, so trials only read the stored arrays and never build or save
+        them concurrently, e.g. the pixel counts that stores built before they were counted save on first use
+        '''
+        import data_processing.DataProcessor as data
+        dataset_names = {trial.get('dataset_name', cfg.dataset_name) for trial in self.trials}
+        dataset_name = cfg.dataset_name
+        for name in dataset_names:
+            cfg.dataset_name = cfg.DataSetNames(getattr(name, 'value', name))
+            dataset = data.get_experiment_data()(downsample_ratio=cfg.downsample_ratio)
+            dataset.load_data()
+            dataset.get_pixel_counts()
+        cfg.dataset_name = dataset_name
+
+    def run(self):
+        if sys.version_info < (3, 11):  # every trial needs a fresh process so no settings leak between trials
+            raise RuntimeError('sweeps need python 3.11 or newer for max_tasks_per_child, this is {}.{}'.format(
+                *sys.version_info[:2]))
+        self.build_datasets()
+        n_threads = max(1, torch.get_num_threads() // self.n_parallel)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.n_parallel, mp_context=context, max_tasks_per_child=1) as pool:
+            futures = {pool.submit(run_trial, i, trial, self.epochs, self.patience, n_threads): i
+                       for i, trial in enumerate(self.trials)}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:  # one failed trial doesn't end the sweep
+                    result = {'trial': futures[future], 'error': repr(e)}
+                print('finished trial {} of {}'.format(len(self.results) + 1, len(self.trials)), **cfg.prnt)
+                self.results.append(result)
+        self.results.sort(key=lambda result: result['trial'])
+        self.save_summary()
+        return self.results
+
+    def get_summary_path(self):
+        return join('..\\ExperimentResults\\', 'sweeps', self.name)
+
+    def save_summary(self):
+        '''
+        writes summary.csv and summary.json and prints the trials ranked by their best val accuracy
+        '''
+        path = self.get_summary_path()
+        os.makedirs(path, exist_ok=True)
+        columns = list(dict.fromkeys(column for result in self.results for column in result))
+        with open(join(path, 'summary.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.results)
+        with open(join(path, 'summary.json'), 'w') as f:
+            json.dump(self.results, f, indent=2)
+        ranked = sorted(self.results, key=lambda result: -result.get('best val accuracy', -1))
+        shown = [column for column in columns if column != 'experiment path']
+        widths = [max(len(column), 10) for column in shown]
+        print(' '.join(column.ljust(width) for column, width in zip(shown, widths)), **cfg.prnt)
+        for result in ranked:
+            print(' '.join(format_value(result.get(column, '')).ljust(width) for column, width in zip(shown, widths)),
+                  **cfg.prnt)
+
+
+def format_value(value):
+    return '{:.4g}'.format(value) if isinstance(value, float) else str(value)
+
+
+def main():
+    '''
+    python -m Model.Sweep [spec.json], the spec holds the Sweep arguments, e.g.
+    {"space": {"lr": [0.5, 0.1], "model_size": [128, 256]}, "search": "grid", "n_parallel": 2}
+    or for a random search {"space": {"lr": {"low": 0.01, "high": 1}}, "search": "random", "n_trials": 8}
+    '''
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            spec = json.load(f)
+        spec['space'] = {name: (values['low'], values['high']) if isinstance(values, dict) else values
+                         for name, values in spec['space'].items()}
+    else:
+        spec = {'space': {'lr': [cfg.lr, cfg.lr / 5], 'weights': [False, True]}}
+    Sweep(**spec).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,18 @@ import numpy as np
 import matplotlib.pyplot as plt
 import itertools
 import seaborn as sns
+import torch
 import Model.Config as cfg
 
 
+def autocast():
+    return torch.autocast(device_type=cfg.device.type, dtype=cfg.amp_dtype, enabled=cfg.mixed_precision)
+
+
+def get_grad_scaler():  # only float16 needs its gradients scaled, bfloat16 has the range of float32
+    return torch.amp.GradScaler(cfg.device.type, enabled=cfg.mixed_precision and cfg.amp_dtype == torch.float16)
+
+
 def plot_confusion_matrix(predictions, ground_truths,
                           results_qualifier,
                           normalize=False,
@@ -15,8 +24,14 @@ def plot_confusion_matrix(predictions, ground_truths,
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
     """
+    plot_matrix(calc_confusion_matrix(predictions, ground_truths), results_qualifier, normalize, title, cmap)
+
+
+def plot_matrix(cm, results_qualifier,
+                normalize=False,
+                title='Confusion matrix',
+                cmap=plt.cm.Blues):
     plt.figure()
-    cm = calc_confusion_matrix(predictions, ground_truths)
     classes = [str(i) for i in range(0, cm.shape[0])]
     if normalize:
         cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
@@ -40,6 +55,7 @@ def accuracy(y_pred, y_true, ignore_index = None):
     for pred, truth in zip(y_pred, y_true):
         accuracy = np.sum(pred == truth)
         if ignore_index is not None:
+            accuracy = np.sum((pred == truth) & (truth != ignore_index))
             total = np.sum(truth != ignore_index)
         else:
             total = np.product(truth.shape)
@@ -58,4 +74,64 @@ def compute_iou(y_pred, y_true, labels):
     predicted_set = current.sum(axis=0)
     union = ground_truth_set + predicted_set - intersection
     IoU = intersection / union.astype(np.float32)
-    return np.mean(IoU)
\ No newline at end of file
+    return np.mean(IoU)
+
+
+class ConfusionMatrix():
+    def __init__(self, n_class, ignore_index=None, device=None):
+        '''
+        confusion matrix accumulated batch by batch on the device the predictions are on, rows are ground truth and
+        columns are predictions
+        '''
+        self.n_class = n_class
+        self.ignore_index = ignore_index
+        self.counts = torch.zeros(n_class * n_class, dtype=torch.int64, device=cfg.device if device is None else device)
+
+    def update(self, predictions, ground_truths, mask=None):
+        '''
+        pixels labelled ignore_index and labels or predictions outside of [0, n_class) (e.g. padding) are skipped
+        :param mask: the pixels to count, e.g. those inside the images since a padding label can be a real class
+        '''
+        predictions = torch.as_tensor(predictions, device=self.counts.device).long()
+        ground_truths = torch.as_tensor(ground_truths, device=self.counts.device).long()
+        valid = (ground_truths >= 0) & (ground_truths < self.n_class) & \
+                (predictions >= 0) & (predictions < self.n_class)
+        if mask is not None:
+            valid &= torch.as_tensor(mask, device=self.counts.device)
+        if self.ignore_index is not None:
+            valid &= ground_truths != self.ignore_index
+        self.counts += torch.bincount(ground_truths[valid] * self.n_class + predictions[valid],
+                                      minlength=self.n_class * self.n_class)
+
+    def get_matrix(self):
+        return self.counts.view(self.n_class, self.n_class).cpu().numpy()
+
+    def pixel_accuracy(self):
+        cm = self.get_matrix()
+        return np.diag(cm).sum() / max(cm.sum(), 1)
+
+    def class_accuracy(self):  # nan for classes that never occur in the ground truth
+        cm = self.get_matrix()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.diag(cm) / cm.sum(axis=1)
+
+    def iou(self):  # nan for classes that are neither in the ground truth nor predicted
+        cm = self.get_matrix()
+        intersection = np.diag(cm)
+        union = cm.sum(axis=1) + cm.sum(axis=0) - intersection
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return intersection / union
+
+    def mean_iou(self):
+        return np.nanmean(self.iou())
+
+    def frequency_weighted_iou(self):
+        cm = self.get_matrix()
+        frequency = cm.sum(axis=1) / max(cm.sum(), 1)
+        return np.nansum(frequency * self.iou())
+
+    def summary(self):
+        return {'pixel accuracy': self.pixel_accuracy(),
+                'mean class accuracy': np.nanmean(self.class_accuracy()),
+                'mean iou': self.mean_iou(),
+                'frequency weighted iou': self.frequency_weighted_iou()}
\ No newline at end of file
@@ -0,0 +1,98 @@
+import torch
+import torch.nn.functional as F
+
+
+class SegmentationAugmenter():
+    def __init__(self, ignore_index, pad_value=-1., flip=.5, scale_range=(.75, 1.25),
+                 brightness=.2, contrast=.2):
+        '''
+        batched augmentation of (x, y) tensors on whatever device they are on, labels are only ever moved with nearest
+        neighbour sampling and pixels that enter the image from outside are labelled ignore_index
+        :param pad_value: value of x outside of the image, -1 is 0 before ProcessedDataSet normalizes the input
+        :param flip: probability of a horizontal flip per sample
+        :param scale_range: one scale per batch so the batch can be resized in a single interpolate call
+        :param brightness: per sample gain in [1 - brightness, 1 + brightness]
+        :param contrast: per sample contrast in [1 - contrast, 1 + contrast]
+        '''
+        self.ignore_index = ignore_index
+        self.pad_value = pad_value
+        self.flip = flip
+        self.scale_range = scale_range
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def __call__(self, x, y, shapes=None):
+        '''
+        :param x: n x c x h x w, y: n x h x w
+        :param shapes: n x 2 height and width of every image before it was padded (see ProcessedDataSet.sample_shapes),
+        None if the images fill the batch
+        '''
+        valid = self.get_valid(shapes, x)
+        x, y, valid = self.random_flip(x, y, valid)
+        x, y, valid = self.random_scale_crop(x, y, valid)
+        x = self.colour_jitter(x, valid)
+        return x, y
+
+    def get_valid(self, shapes, x):
+        '''
+        :return: n x h x w mask of the image pixels, the top left height x width of every sample, neither the labels nor
+        the pixel values tell the padding apart since ignored and black pixels lie inside the images too
+        '''
+        n, _, height, width = x.shape
+        if shapes is None:
+            return torch.ones((n, height, width), dtype=torch.bool, device=x.device)
+        shapes = torch.as_tensor(shapes, device=x.device).view(n, 2, 1, 1)
+        rows = torch.arange(height, device=x.device).view(1, -1, 1)
+        columns = torch.arange(width, device=x.device).view(1, 1, -1)
+        return (rows < shapes[:, 0]) & (columns < shapes[:, 1])
+
+    def uniform(self, n, spread, device):
+        return 1 + (2 * torch.rand(n, device=device) - 1) * spread
+
+    def random_flip(self, x, y, valid):
+        flip = torch.rand(x.shape[0], device=x.device) < self.flip
+        x = torch.where(flip.view(-1, 1, 1, 1), x.flip(-1), x)
+        y = torch.where(flip.view(-1, 1, 1), y.flip(-1), y)
+        valid = torch.where(flip.view(-1, 1, 1), valid.flip(-1), valid)
+        return x, y, valid
+
+    def random_scale_crop(self, x, y, valid):
+        '''
+        rescales the batch and takes a random window of the original size from each sample, a smaller image is placed
+        at a random position of the window instead
+        '''
+        n, _, height, width = x.shape
+        scale = float(torch.empty(1).uniform_(*self.scale_range))
+        scaled_height, scaled_width = max(1, round(height * scale)), max(1, round(width * scale))
+        x = F.interpolate(x, (scaled_height, scaled_width), mode='bilinear', align_corners=False)
+        y = F.interpolate(y.unsqueeze(1).float(), (scaled_height, scaled_width), mode='nearest').squeeze(1).long()
+        valid = F.interpolate(valid.unsqueeze(1).float(), (scaled_height, scaled_width), mode='nearest').squeeze(1) > 0
+
+        pad_height, pad_width = max(height - scaled_height, 0), max(width - scaled_width, 0)
+        x = F.pad(x, (pad_width, pad_width, pad_height, pad_height), value=self.pad_value)
+        y = F.pad(y, (pad_width, pad_width, pad_height, pad_height), value=self.ignore_index)
+        valid = F.pad(valid, (pad_width, pad_width, pad_height, pad_height), value=False)
+
+        offset_rows = torch.randint(0, x.shape[-2] - height + 1, (n, 1), device=x.device)
+        offset_columns = torch.randint(0, x.shape[-1] - width + 1, (n, 1), device=x.device)
+        rows = (offset_rows + torch.arange(height, device=x.device)).unsqueeze(2)
+        columns = (offset_columns + torch.arange(width, device=x.device)).unsqueeze(1)
+        samples = torch.arange(n, device=x.device).view(-1, 1, 1)
+        x = x[samples, :, rows, columns].permute(0, 3, 1, 2).contiguous()  # advanced indexes go first: n x h x w x c
+        y = y[samples, rows, columns]
+        valid = valid[samples, rows, columns]
+        return x, y, valid
+
+    def colour_jitter(self, x, valid):
+        '''
+        :param valid: n x h x w mask of the image pixels, only they are jittered and contribute to the contrast mean
+        '''
+        n, channels = x.shape[:2]
+        gain = self.uniform(n, self.brightness, x.device).view(-1, 1, 1, 1)
+        contrast = self.uniform(n, self.contrast, x.device).view(-1, 1, 1, 1)
+        jittered = (x + 1) * gain - 1  # scales the unnormalized intensities
+        valid = valid.unsqueeze(1)
+        n_valid = torch.clamp(valid.sum(dim=(1, 2, 3), keepdim=True) * channels, min=1)
+        mean = (jittered * valid).sum(dim=(1, 2, 3), keepdim=True) / n_valid
+        jittered = (jittered - mean) * contrast + mean
+        return torch.where(valid, jittered, x)  # padding keeps its value
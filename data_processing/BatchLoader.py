@@ -0,0 +1,73 @@
+import torch
+import numpy as np
+import Model.Config as cfg
+import data_processing.DataProcessor as dp
+from data_processing.Samplers import BucketBatchSampler
+from data_processing.Augmentation import SegmentationAugmenter
+
+
+class SegmentationBatches(torch.utils.data.Dataset):
+    def __init__(self, data: dp.ProcessedDataSet, index_range: range, sampler: BucketBatchSampler,
+                 augmenter: SegmentationAugmenter = None):
+        '''
+        map style dataset over one split of a ProcessedDataSet that is indexed with whole batches from sampler, so each
+        batch is gathered with a single fancy index, cropped to its shape bucket and augmented if augmenter is given
+        the batches are (x, y, the height and width of every image before padding) tensors
+        '''
+        self.stored_folder_path = data.stored_folder_path
+        self.index_range = index_range
+        self.sampler = sampler
+        self.augmenter = augmenter
+        self.x = data.x[dp.range_slice(index_range)]
+        self.y = data.y[dp.range_slice(index_range)]
+        self.shapes = None if data.sample_shapes is None else np.array(data.sample_shapes[dp.range_slice(index_range)])
+
+    def __getstate__(self):  # workers reopen the memory maps instead of receiving a pickled copy of the arrays
+        state = self.__dict__.copy()
+        if isinstance(self.x, np.memmap) and isinstance(self.y, np.memmap):
+            state['x'] = state['y'] = None
+        return state
+
+    def get_arrays(self):
+        if self.x is None:
+            self.x = dp.load_array(self.stored_folder_path, 'x.npy')[dp.range_slice(self.index_range)]
+            self.y = dp.load_array(self.stored_folder_path, 'y.npy')[dp.range_slice(self.index_range)]
+        return self.x, self.y
+
+    def __len__(self):
+        return len(self.index_range)
+
+    def __getitem__(self, indexes):
+        x, y = self.get_arrays()
+        height, width = self.sampler.get_shape(indexes)
+        x_batch = np.ascontiguousarray(x[indexes][..., :height, :width])
+        y_batch = y[indexes][..., :height, :width].astype(np.int64)
+        if self.shapes is None:  # stores built before the shapes were kept, every image fills its batch
+            shapes = np.tile([height, width], (len(indexes), 1))
+        else:
+            shapes = np.minimum(self.shapes[indexes][:, :2], [height, width])
+        x_batch, y_batch = torch.from_numpy(x_batch), torch.from_numpy(y_batch)
+        shapes = torch.from_numpy(shapes.astype(np.int64))
+        if self.augmenter is not None:
+            x_batch, y_batch = self.augmenter(x_batch, y_batch, shapes)
+        return x_batch, y_batch, shapes
+
+
+def get_loader(data: dp.ProcessedDataSet, index_range: range, sampler: BucketBatchSampler,
+               augmenter: SegmentationAugmenter = None, n_workers=None, prefetch_batches=None, pin_memory=None,
+               persistent_workers=True):
+    '''
+    batches are gathered by n_workers background processes (in the calling process if 0) into pinned memory, each
+    worker keeps prefetch_batches batches ready
+    :param persistent_workers: False starts new workers every epoch, seeded from the global torch random state
+    '''
+    n_workers = cfg.loader_workers if n_workers is None else n_workers
+    prefetch_batches = cfg.prefetch_batches if prefetch_batches is None else prefetch_batches
+    pin_memory = cfg.pin_memory if pin_memory is None else pin_memory
+    return torch.utils.data.DataLoader(SegmentationBatches(data, index_range, sampler, augmenter),
+                                       sampler=sampler,
+                                       batch_size=None,  # the sampler yields whole batches
+                                       num_workers=n_workers,
+                                       prefetch_factor=prefetch_batches if n_workers > 0 else None,
+                                       persistent_workers=persistent_workers and n_workers > 0,
+                                       pin_memory=pin_memory)
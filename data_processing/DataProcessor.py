@@ -1,9 +1,12 @@
 import scipy.io
 import os
+import time
+import multiprocessing
 from os.path import join, isfile
 import numpy as np
 import cv2
 import pickle
+import json
 import Model.Config as cfg
 from PIL import Image
 
@@ -33,13 +36,92 @@ def load_object(path, filename = None):
     else:
         return None
 
+
+def save_json(obj, path, filename):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(join(path, filename), 'w') as f:
+        json.dump(obj, f, indent=2)
+
+
+def load_json(path, filename):
+    path = join(path, filename)
+    if isfile(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return None
+
+
+def save_array(array, path, filename):
+    '''
+    writes array as a .npy file that can be opened again with np.load(..., mmap_mode='r'), an array that is already
+    memory mapped from that file is only flushed
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    path = join(path, filename)
+    if isinstance(array, np.memmap) and array.filename is not None \
+            and os.path.abspath(array.filename) == os.path.abspath(path):
+        array.flush()
+        return
+    np.save(path, array)
+
+
+def load_array(path, filename, mmap_mode='r'):
+    path = join(path, filename)
+    if isfile(path):
+        return np.load(path, mmap_mode=mmap_mode)
+    return None
+
+
+def range_slice(index_range: range):
+    return slice(index_range.start, index_range.stop)  # slicing keeps memory mapped arrays as views
+
+
+def max_shape(shapes):
+    return tuple(int(max(dims)) for dims in zip(*shapes))
+
+
+def count_labels(y, n_labels, ignore_index=None, chunk_size=64):
+    '''
+    per image pixel count of every label with one bincount per chunk of images, labels are offset by the image's
+    position in the chunk so a single flat bincount counts all of them at once
+    :return: n_images x n_labels, ignore_index and labels outside of [0, n_labels) are not counted
+    '''
+    counts = np.zeros((y.shape[0], n_labels), dtype=np.int64)
+    for start in range(0, y.shape[0], chunk_size):
+        chunk = np.asarray(y[start:start + chunk_size], dtype=np.int64)
+        chunk = chunk.reshape(chunk.shape[0], -1)
+        valid = (chunk >= 0) & (chunk < n_labels)
+        if ignore_index is not None:
+            valid &= chunk != ignore_index
+        chunk = np.where(valid, chunk, n_labels)  # dumped into an extra column that is dropped
+        chunk += np.arange(chunk.shape[0]).reshape(-1, 1) * (n_labels + 1)
+        chunk_counts = np.bincount(chunk.ravel(), minlength=chunk.shape[0] * (n_labels + 1))
+        counts[start:start + chunk.shape[0]] = chunk_counts.reshape(-1, n_labels + 1)[:, :n_labels]
+    return counts
+
+
+def read_image_shape(file):  # PIL only parses the header until the pixels are accessed
+    with Image.open(file) as img:
+        width, height = img.size
+        n_bands = len(img.getbands())
+    return (height, width) if n_bands == 1 else (height, width, n_bands)
+
+
 class ProcessedDataSet():
     def __init__(self, dataset_name, x_dtype=None, y_dtype=None,
                  downsample_ratio = 1, test_ratio = .2, validate_ratio = .2):
         self.x = None
         self.y = None
         self.dataset_name = dataset_name
-        self.stored_file_name = self.dataset_name + '.pkl'
+        self.stored_file_name = self.dataset_name + '.pkl'  # whole object pickle written by older versions
+        self.stored_folder_path = join(cfg.processed_data_path, self.dataset_name)
+        self.metadata_file_name = 'metadata.json'
+        self.stored_arrays = ['x', 'y', 'sample_shapes', 'pixel_counts']
+        self.sample_shapes = None
+        self.pixel_counts = None  # n_samples x (largest label + 1), pixels of every label value in every sample
+        self.buckets = None
         self.n_classes = None
         self.x_shape = None
         self.n_samples = None
@@ -55,6 +137,61 @@ class ProcessedDataSet():
 
     def calc_class_weights(self, y): #todo assign classes variables here
         unique, counts = np.unique(y, return_counts=True)
+        self.set_class_weights(unique, counts)
+
+    def get_pixel_counts(self):
+        '''
+        counted when the dataset is built, stores built before are counted (and saved) on first use
+        '''
+        if self.pixel_counts is None:
+            self.pixel_counts = count_labels(self.y, int(np.max(self.y)) + 1)
+            self.save()
+        return self.pixel_counts
+
+    def get_label_presence(self):  # n_samples x labels, ignore_index excluded
+        presence = self.get_pixel_counts() > 0
+        if 0 <= self.ignore_index < presence.shape[1]:
+            presence[:, self.ignore_index] = False
+        return presence
+
+    def get_sample_weights(self, index_range, power=.5):
+        '''
+        weight of every sample in index_range by its rare class area: each label gets a rarity of
+        (labelled pixels / pixels of the label) ** power over index_range and a sample's weight is the mean rarity of
+        its labelled pixels, so an image that is mostly a rare class weighs about as much as that class's rarity
+        :param power: 0 samples uniformly, 1 uses the inverse pixel frequency of every label
+        '''
+        counts = self.get_pixel_counts()[range_slice(index_range)].astype(np.float64)
+        if 0 <= self.ignore_index < counts.shape[1]:
+            counts[:, self.ignore_index] = 0
+        totals = counts.sum(axis=0)
+        rarity = np.zeros_like(totals)
+        rarity[totals > 0] = (totals.sum() / totals[totals > 0]) ** power
+        labelled = counts.sum(axis=1)
+        weights = counts @ rarity / np.maximum(labelled, 1)
+        weights[labelled == 0] = rarity[totals > 0].min() if np.any(totals > 0) else 1  # nothing to oversample
+        return weights
+
+    def calc_class_weights_from_counts(self):
+        totals = self.get_pixel_counts().sum(axis=0)
+        unique = np.flatnonzero(totals)
+        self.set_class_weights(unique, totals[unique])
+
+    def get_statistics(self):
+        '''
+        derived from the pixel count table, y is not read
+        '''
+        counts = self.get_pixel_counts()
+        presence = self.get_label_presence()
+        labelled = presence.any(axis=0)
+        labelled_counts = counts[:, labelled]
+        return {'labels': np.flatnonzero(labelled).tolist(),
+                'pixel frequency': (labelled_counts.sum(axis=0) / max(labelled_counts.sum(), 1)).tolist(),
+                'images per label': presence[:, labelled].sum(axis=0).tolist(),
+                'labels per image': float(presence.sum(axis=1).mean()),
+                'labelled pixels per image': float(labelled_counts.sum(axis=1).mean())}
+
+    def set_class_weights(self, unique, counts):
         totalCount = sum(counts)
         self.class_weights = [(totalCount + 1000 ) / c for c in counts]
         print(len(self.class_weights))
@@ -64,19 +201,19 @@ class ProcessedDataSet():
     def get_train_data(self):
         if self.x is None and self.y is None:
             self.load_data()
-        indeces = self.train_range
+        indeces = range_slice(self.train_range)
         return self.x[indeces], self.y[indeces]
 
     def get_val_data(self):
         if self.x is None and self.y is None:
             self.load_data()
-        indeces = self.val_range
+        indeces = range_slice(self.val_range)
         return self.x[indeces], self.y[indeces]
 
     def get_test_data(self):
         if self.x is None and self.y is None:
             self.load_data()
-        indeces = self.test_range
+        indeces = range_slice(self.test_range)
         return self.x[indeces], self.y[indeces]
 
     def get_full_data(self):
@@ -87,6 +224,61 @@ class ProcessedDataSet():
     def get_class_weights(self):
         return self.class_weights
 
+    def get_sample_shapes(self, index_range):  # n x 2 image shapes before padding, None for stores built without them
+        if self.sample_shapes is None:
+            return None
+        return np.array(self.sample_shapes[range_slice(index_range)])  # a copy, the store's memory map is read only
+
+    def get_buckets(self, index_range):
+        '''
+        :return: [start, stop, height, width] of each shape bucket inside index_range, start and stop relative to it
+        '''
+        if self.buckets is None:  # stores built before bucketing, the whole range padded to the dataset shape
+            return [[0, len(index_range)] + [int(dim) for dim in self.y.shape[-2:]]]
+        return [[start - index_range.start, stop - index_range.start, height, width]
+                for start, stop, height, width in self.buckets
+                if start >= index_range.start and stop <= index_range.stop]
+
+    def assign_buckets(self, sample_shapes, n_buckets=None):
+        '''
+        groups the samples of each split into at most n_buckets shape buckets, each bucket is padded to its own largest
+        height and width instead of the largest of the whole dataset
+        :param sample_shapes: n_samples x 2, downsampled height and width of each sample before padding
+        :return: order of the samples that keeps every split in place and makes every bucket contiguous
+        '''
+        n_buckets = cfg.n_buckets if n_buckets is None else n_buckets
+        order = []
+        self.buckets = []
+        for index_range in (self.train_range, self.val_range, self.test_range):
+            indexes = np.arange(index_range.start, index_range.stop)
+            if len(indexes) == 0:
+                continue
+            shapes = sample_shapes[indexes]
+            sorting = np.lexsort((shapes[:, 1], shapes[:, 0]))  # by height, then width
+            indexes, shapes = indexes[sorting], shapes[sorting]
+            unique_shapes, first_indexes = np.unique(shapes, axis=0, return_index=True)
+            if len(unique_shapes) <= n_buckets:  # one bucket per shape, no padding at all
+                chunks = np.split(indexes, np.sort(first_indexes)[1:])
+            else:
+                chunks = np.array_split(indexes, n_buckets)
+            for chunk in chunks:
+                start = len(order)
+                order.extend(chunk)
+                height, width = sample_shapes[chunk].max(axis=0)
+                self.buckets.append([start, len(order), int(height), int(width)])
+        order = np.array(order)
+        self.sample_shapes = sample_shapes[order]
+        return order
+
+    def bucket_report(self):
+        image_pixels = int(np.sum(np.prod(self.sample_shapes, axis=1, dtype=np.int64)))
+        padded_pixels = self.n_samples * int(np.prod(self.y.shape[-2:])) - image_pixels
+        bucket_padded_pixels = sum((stop - start) * height * width
+                                   for start, stop, height, width in self.buckets) - image_pixels
+        print('padded pixels with one shape: {}, with {} buckets: {}, {:.1%} fewer'.format(
+            padded_pixels, len(self.buckets), bucket_padded_pixels,
+            1 - bucket_padded_pixels / max(padded_pixels, 1)))
+
     def split_data(self): #todo, right no we take the validation set from the testing dp, either generalize or follow proper practice
         new_splits = []
         data_splits = self.data_observations.data_splits
@@ -95,6 +287,8 @@ class ProcessedDataSet():
             new_splits.append(new_splits[-1] + (self.n_samples - new_splits[-1])*(self.validate_ratio))
         if len(data_splits) == 1: # we are assigning the validate split here
             new_splits = [data_splits[-1], data_splits[-1] + (self.n_samples - data_splits[-1])*(self.validate_ratio)]
+        if len(data_splits) == 2: # train, validate and test sets are all given
+            new_splits = [data_splits[0], data_splits[0] + data_splits[1]]
         self.set_data_split(int(new_splits[0]), int(new_splits[1]))
 
     def set_data_split(self, train_val_split, val_test_split):
@@ -102,32 +296,132 @@ class ProcessedDataSet():
         self.val_range = range(train_val_split, val_test_split)
         self.test_range = range(val_test_split, self.n_samples)
 
+    def get_metadata(self):
+        return {
+            'n_classes': int(self.n_classes),
+            'x_shape': [int(dim) for dim in self.x_shape],
+            'n_samples': int(self.n_samples),
+            'class_weights': [float(weight) for weight in self.class_weights],
+            'ignore_index': int(self.ignore_index),
+            'downsample_ratio': self.downsample_ratio,
+            'splits': [self.train_range.stop, self.val_range.stop],
+            'buckets': self.buckets,
+            'arrays': {name: {'shape': [int(dim) for dim in getattr(self, name).shape],
+                              'dtype': str(getattr(self, name).dtype)} for name in self.stored_arrays
+                       if getattr(self, name) is not None},
+        }
+
+    def set_metadata(self, metadata):
+        self.n_classes = metadata['n_classes']
+        self.x_shape = tuple(metadata['x_shape'])
+        self.n_samples = metadata['n_samples']
+        self.class_weights = metadata['class_weights']
+        self.ignore_index = metadata['ignore_index']
+        self.downsample_ratio = metadata['downsample_ratio']
+        self.buckets = metadata.get('buckets')
+        self.set_data_split(*metadata['splits'])
+
     def try_load(self):
-        if isfile(cfg.processed_data_path + self.stored_file_name):
-            obj_dict = load_object(cfg.processed_data_path, self.stored_file_name)
-            self.__dict__.update(obj_dict)
-            return True
-        return False
+        '''
+        opens the stored arrays as read only memory maps, so loading costs the same regardless of the dataset size
+        '''
+        metadata = load_json(self.stored_folder_path, self.metadata_file_name)
+        if metadata is None:
+            return self.try_load_pickle()
+        arrays = {name: load_array(self.stored_folder_path, name + '.npy') for name in metadata['arrays']}
+        if any(array is None for array in arrays.values()):
+            return False
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.set_metadata(metadata)
+        return True
+
+    def try_load_pickle(self):  # converts a cache written by older versions to the array store
+        obj_dict = load_object(cfg.processed_data_path, self.stored_file_name)
+        if obj_dict is None:
+            return False
+        self.__dict__.update(obj_dict)
+        self.save()
+        return self.try_load()
 
     def save(self):
-        save_object(self.__dict__, cfg.processed_data_path, self.stored_file_name)
+        metadata_path = join(self.stored_folder_path, self.metadata_file_name)
+        if isfile(metadata_path):  # the metadata is written last, so a partially written store is never loaded
+            os.remove(metadata_path)
+        for name in self.stored_arrays:
+            if getattr(self, name) is not None:
+                save_array(getattr(self, name), self.stored_folder_path, name + '.npy')
+        save_json(self.get_metadata(), self.stored_folder_path, self.metadata_file_name)
 
     def load_data(self):  # c x h x w this implementation is load_data for images
         if not self.try_load():
-            x_full, x = self.data_observations.load_data_from_files()
-            y_full, y = self.data_labels.load_data_from_files()
-            self.n_samples = x_full.shape[0]
-            self.split_data()
-            self.calc_class_weights(y_full)
+            if cfg.stream_build:
+                self.build_streaming()
+            else:
+                self.build()
+            self.pixel_counts = count_labels(self.y, int(np.max(self.y)) + 1)
+            self.calc_class_weights_from_counts()
             self.n_classes = len(self.class_weights)
-            if self.x_dtype is not None and x.dtype != self.x_dtype:
-                x = x.astype(self.x_dtype)
-            if self.y_dtype is not None and y.dtype != self.y_dtype:
-                y = y.astype(self.y_dtype)
-            self.x = self.cleanInput(x)
-            self.y = y
-            self.x_shape = self.x.shape
+            self.bucket_report()
             self.save()
+            self.try_load()  # swap the in memory arrays for the stored memory maps
+
+    def build(self):
+        x_full, x = self.data_observations.load_data_from_files()
+        y_full, y = self.data_labels.load_data_from_files()
+        self.n_samples = x_full.shape[0]
+        self.split_data()
+        order = self.assign_buckets(np.array([shape[:2] for shape in self.data_observations.sample_shapes]))
+        x, y = x[order], y[order]
+        if self.x_dtype is not None and x.dtype != self.x_dtype:
+            x = x.astype(self.x_dtype)
+        if self.y_dtype is not None and y.dtype != self.y_dtype:
+            y = y.astype(self.y_dtype)
+        self.x = self.cleanInput(x)
+        self.y = y
+        self.x_shape = self.x.shape
+
+    def allocate(self, name, shape, dtype):
+        if cfg.memmap_build:
+            if not os.path.exists(self.stored_folder_path):
+                os.makedirs(self.stored_folder_path)
+            return np.lib.format.open_memmap(join(self.stored_folder_path, name + '.npy'),
+                                             mode='w+', dtype=dtype, shape=shape)
+        return np.empty(shape, dtype=dtype)
+
+    def build_streaming(self):
+        '''
+        builds the same arrays as build without ever holding the full resolution data, the first pass only reads shapes
+        and the second writes each padded, downsampled sample into a preallocated array
+        '''
+        x_files, x_shapes = self.data_observations.get_stream_layout()
+        y_files, y_shapes = self.data_labels.get_stream_layout()
+        self.n_samples = len(x_files)
+        self.split_data()
+        order = self.assign_buckets(np.array([shape[:2] for shape in x_shapes]))
+        x_files, x_shapes = [x_files[i] for i in order], [x_shapes[i] for i in order]
+        y_files, y_shapes = [y_files[i] for i in order], [y_shapes[i] for i in order]
+
+        x_sample_shape = max_shape(x_shapes)
+        channels_last = len(x_sample_shape) > 2
+        x_shape = (self.n_samples,) + ((x_sample_shape[-1],) + x_sample_shape[:-1] if channels_last else x_sample_shape)
+        self.x = self.allocate('x', x_shape, self.x_dtype or np.float32)
+        channel_sums = np.zeros(x_shape[1] if channels_last else 1)
+        for i, datum in enumerate(self.data_observations.stream_files(x_files, x_sample_shape)):
+            if channels_last:
+                datum = np.transpose(datum, (2, 0, 1))
+            channel_sums += datum.reshape(channel_sums.shape[0], -1).sum(axis=1)
+            self.x[i] = datum
+        averages = channel_sums / (self.n_samples * x_sample_shape[0] * x_sample_shape[1])  # as cleanInput, padding included
+        averages = averages.reshape(-1, 1, 1) if channels_last else averages
+        for i in range(self.n_samples):
+            self.x[i] = (self.x[i] - averages) / averages
+        self.x_shape = self.x.shape
+
+        y_sample_shape = max_shape(y_shapes)
+        self.y = self.allocate('y', (self.n_samples,) + y_sample_shape, self.y_dtype or np.int32)
+        for i, datum in enumerate(self.data_labels.stream_files(y_files, y_sample_shape)):
+            self.y[i] = datum
 
     def cleanInput(self, x):
         print('...reshaped from ', x.shape)
@@ -141,23 +435,25 @@ class ProcessedDataSet():
 
 
 class DataBSR(ProcessedDataSet):
-    def __init__(self, x_dtype=np.float32, y_dtype=np.int32, downsample_ratio=4):
+    def __init__(self, x_dtype=np.float32, y_dtype=np.int32, downsample_ratio=4, n_workers=None):
         super(DataBSR, self).__init__('BSR', x_dtype, y_dtype)
         self.downsample_ratio = downsample_ratio
-        self.data_observations = BSRImages(downsample_ratio)
-        self.data_labels = BSRLabels(downsample_ratio)
+        self.data_observations = BSRImages(downsample_ratio, n_workers)
+        self.data_labels = BSRLabels(downsample_ratio, n_workers)
 
 class DataVOC(ProcessedDataSet):
-    def __init__(self, x_dtype=np.float32, y_dtype=np.int32, downsample_ratio=4):
+    def __init__(self, x_dtype=np.float32, y_dtype=np.int32, downsample_ratio=4, n_workers=None):
         super(DataVOC, self).__init__('VOC', x_dtype, y_dtype)
         self.downsample_ratio = downsample_ratio
-        self.data_observations = VOCImages(downsample_ratio)
-        self.data_labels = VOCLabels(downsample_ratio)
+        self.data_observations = VOCImages(downsample_ratio, n_workers)
+        self.data_labels = VOCLabels(downsample_ratio, n_workers)
         self.ignore_index = 255 # according to voc2012, 255 is unlabeled/void
 
 class DataFileLoader():
-    def __init__(self, downsample_ratio, pad_value = 0):
+    def __init__(self, downsample_ratio, pad_value = 0, n_workers = None, report_every = 500):
         self.pad_value = pad_value
+        self.n_workers = cfg.n_workers if n_workers is None else n_workers
+        self.report_every = report_every
         self.stored_data_path = None
         self.stored_file_name = None
         self.sampled_file_name = None
@@ -165,10 +461,23 @@ class DataFileLoader():
         self.train_range = None
         self.val_range = None
         self.test_range = None
+        self.sample_shapes = []  # shapes of the downsampled data before padding
 
     def read_file(self, file):
         raise NotImplementedError
 
+    def read_shape(self, file):
+        '''
+        shape of the full resolution datum, loaders that can get it without decoding the whole file should override this
+        '''
+        return self.read_file(file)[0].shape
+
+    def read_downsampled(self, file):
+        return self.read_file(file)[1]
+
+    def downsampled_shape(self, shape):
+        return (shape[0] // self.downsample_ratio, shape[1] // self.downsample_ratio) + tuple(shape[2:])
+
     def get_file_sets(self):
         '''
         :return: list of list of files, if applicable the first dimension should be split by train, val, test sets
@@ -180,7 +489,7 @@ class DataFileLoader():
         return np.pad(image,
                       pad_width=pad_width, mode='constant', constant_values=self.pad_value)
 
-    def shape_data_uniform(self, data: list): # todo bucketize if different sizes
+    def shape_data_uniform(self, data: list): # shape buckets are assigned by ProcessedDataSet.assign_buckets
         max_dims = [0]*len(data[0].shape)
         for i in range(0, len(data)):
             image = data[i]
@@ -189,13 +498,42 @@ class DataFileLoader():
             max_dims = [max(image.shape[dim_idx], max_dims[dim_idx]) for dim_idx in range(0, len(max_dims))]
         return [self.pad(image=image, max_shape=max_dims) for image in data]
 
+    def iter_read_files(self, files, downsampled_only=False):
+        '''
+        reads files with a pool of self.n_workers processes (serially if 1), results come back in the order of files
+        :param downsampled_only: only the downsampled data is returned (and sent back from the workers)
+        :return: generator of read_file outputs
+        '''
+        read = self.read_downsampled if downsampled_only else self.read_file
+        n_files = len(files)
+        n_workers = min(self.n_workers or 1, n_files)
+        # spawned rather than forked workers, forking after cv2 or torch have started their thread pools can deadlock
+        pool = multiprocessing.get_context('spawn').Pool(processes=n_workers) if n_workers > 1 else None
+        if pool is None:
+            results = map(read, files)
+        else:
+            chunksize = max(1, n_files // (n_workers * 8))  # small chunks keep the ordered stream flowing
+            results = pool.imap(read, files, chunksize=chunksize)
+        start = time.time()
+        try:
+            for i, result in enumerate(results):
+                yield result
+                if (i + 1) % self.report_every == 0 or i + 1 == n_files:
+                    elapsed = time.time() - start
+                    print('read {}/{} files with {} worker(s), {:.1f} files/s'.format(
+                        i + 1, n_files, n_workers, (i + 1) / max(elapsed, 1e-6)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
     def read_files(self, files):
         data = []
         data_downsampled = []
-        for sample_path in files:
-            image, image_downsampled = self.read_file(sample_path)
+        for image, image_downsampled in self.iter_read_files(files):
             data.append(image)
             data_downsampled.append(image_downsampled)
+            self.sample_shapes.append(image_downsampled.shape)
         data = self.shape_data_uniform(data)
         data_downsampled = self.shape_data_uniform(data_downsampled)
         return np.stack(data), np.stack(data_downsampled)
@@ -204,6 +542,7 @@ class DataFileLoader():
         data = []
         data_downsampled = []
         file_sets = self.get_file_sets()
+        self.sample_shapes = []
         for file_list in file_sets:
             processed = self.read_files(file_list)
             data.append(processed[0])
@@ -214,10 +553,28 @@ class DataFileLoader():
         self.data_splits = [len(file_sets[i]) for i in range(0, len(file_sets)-1)]
         return data, data_downsampled
 
+    def get_stream_layout(self):
+        '''
+        metadata only pass over the files, see read_shape
+        :return: flat list of files, downsampled shape of each file
+        '''
+        file_sets = self.get_file_sets()
+        files = [sample_path for file_list in file_sets for sample_path in file_list]
+        shapes = [self.downsampled_shape(self.read_shape(sample_path)) for sample_path in files]
+        self.data_splits = [len(file_sets[i]) for i in range(0, len(file_sets)-1)]
+        return files, shapes
+
+    def stream_files(self, files, sample_shape):
+        '''
+        :return: generator of the downsampled data of files padded to sample_shape, one datum in memory at a time
+        '''
+        for datum_downsampled in self.iter_read_files(files, downsampled_only=True):
+            yield self.pad(image=datum_downsampled, max_shape=sample_shape)
+
 
 class VOCImages(DataFileLoader):
-    def __init__(self, downsample_ratio):
-        super(VOCImages, self).__init__(downsample_ratio, pad_value=0)
+    def __init__(self, downsample_ratio, n_workers=None):
+        super(VOCImages, self).__init__(downsample_ratio, pad_value=0, n_workers=n_workers)
         self.file_ext = '.jpg'
         self.year_paths = ['..\\Data\\VOC\\VOCdevkit\\VOC20{}\\'.format(i) for i in ['08', '09', '10', '11', '12']]
         self.image_paths =  [root_path + 'JPEGImages\\' for root_path in self.year_paths]
@@ -229,6 +586,9 @@ class VOCImages(DataFileLoader):
                                        interpolation=cv2.INTER_LINEAR)
         return datum, datum_downsampled
 
+    def read_shape(self, file):
+        return read_image_shape(file)
+
     def get_file_sets(self):
         file_sets = []
         for image_lists_path in self.image_set_paths:
@@ -244,8 +604,8 @@ class VOCImages(DataFileLoader):
         return file_sets
 
 class VOCLabels(DataFileLoader):
-    def __init__(self, downsample_ratio):
-        super(VOCLabels, self).__init__(downsample_ratio, pad_value=255)
+    def __init__(self, downsample_ratio, n_workers=None):
+        super(VOCLabels, self).__init__(downsample_ratio, pad_value=255, n_workers=n_workers)
         self.file_ext = '.png'
         self.year_paths = ['..\\Data\\VOC\\VOCdevkit\\VOC20{}\\'.format(i) for i in ['08', '09', '10', '11', '12']]
         self.image_paths =  [root_path + 'SegmentationClass\\' for root_path in self.year_paths]
@@ -258,6 +618,9 @@ class VOCLabels(DataFileLoader):
                                        interpolation=cv2.INTER_NEAREST)
         return datum, datum_downsampled
 
+    def read_shape(self, file):
+        return read_image_shape(file)
+
     def get_file_sets(self):
         file_sets = []
         for image_lists_path in self.image_set_paths:
@@ -274,8 +637,8 @@ class VOCLabels(DataFileLoader):
 
 
 class BSRImages(DataFileLoader):
-    def __init__(self, downsample_ratio):
-        super(BSRImages, self).__init__(downsample_ratio)
+    def __init__(self, downsample_ratio, n_workers=None):
+        super(BSRImages, self).__init__(downsample_ratio, n_workers=n_workers)
         self.file_ext = '.jpg'
         self.root_path = '..\\Data\\BSR\\BSDS500\\dp\\images\\'
         self.image_set_paths = [self.root_path + i for i in ['train', 'val', 'test']]
@@ -286,6 +649,9 @@ class BSRImages(DataFileLoader):
                                        interpolation=cv2.INTER_LINEAR)
         return datum, datum_downsampled
 
+    def read_shape(self, file):
+        return read_image_shape(file)
+
     def get_file_sets(self):
         file_sets = []
         for path in self.image_set_paths:
@@ -299,8 +665,8 @@ class BSRImages(DataFileLoader):
 
 
 class BSRLabels(DataFileLoader):
-    def __init__(self, downsample_ratio):
-        super(BSRLabels, self).__init__(downsample_ratio)
+    def __init__(self, downsample_ratio, n_workers=None):
+        super(BSRLabels, self).__init__(downsample_ratio, n_workers=n_workers)
         self.file_ext = '.mat'
         self.root_path = '..\\Data\\BSR\\BSDS500\\dp\\groundTruth\\'
         self.image_set_paths = [self.root_path + i for i in ['train', 'val', 'test']]
@@ -0,0 +1,114 @@
+import torch
+import numpy as np
+import os
+from os.path import join
+import Model.Config as cfg
+import data_processing.DataProcessor as dp
+
+
+class EpisodeStore(torch.utils.data.IterableDataset):
+    def __init__(self, folder, meta_batch_size=1, read_x=True, seed=24):
+        '''
+        episodes of a KShotSegmentationDataGenerator materialized on disk, the support images and the query of every
+        episode are one contiguous record of a memory mapped shard, so a batch of consecutive episodes is a single
+        sequential read, loader workers iterate disjoint shards
+        :param meta_batch_size: consecutive episodes of a shard per batch
+        :param read_x: False only reads the labels and image indexes, e.g. when the images are replaced by cached
+        encoder features
+        '''
+        self.folder = folder
+        self.metadata_file_name = 'metadata.json'
+        self.meta_batch_size = meta_batch_size
+        self.read_x = read_x
+        self.seed = seed
+        self.epoch = torch.zeros((), dtype=torch.int64).share_memory_()  # seen by persistent loader workers
+        self.metadata = dp.load_json(folder, self.metadata_file_name)
+        self.shards = {}  # shard -> (images, x, y) memory maps, opened lazily in every process
+
+    def exists(self):
+        return self.metadata is not None
+
+    def get_n_support(self):
+        return self.metadata['n_support']
+
+    def __len__(self):  # batches per epoch
+        return sum(int(np.ceil((stop - start) / self.meta_batch_size)) for start, stop in self.metadata['shards'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_file_name(self, name, shard):
+        return '{}_{}.npy'.format(name, shard)
+
+    def build(self, generator, n_support, episodes_per_shard=None):
+        '''
+        writes every episode with n_support sampled support images, episodes are shuffled once so each shard is a
+        random subset and batches of consecutive episodes are random batches
+        :param generator: KShotSegmentationDataGenerator with its meta sets created
+        '''
+        episodes_per_shard = cfg.episodes_per_shard if episodes_per_shard is None else episodes_per_shard
+        rng = np.random.default_rng(self.seed)
+        dataset = generator.dataset
+        episodes = rng.permutation(generator.get_episode_indexes())
+        os.makedirs(self.folder, exist_ok=True)
+        metadata_path = join(self.folder, self.metadata_file_name)
+        if os.path.exists(metadata_path):  # an interrupted build must not look complete
+            os.remove(metadata_path)
+        shards = []
+        for shard, start in enumerate(range(0, len(episodes), episodes_per_shard)):
+            stop = min(start + episodes_per_shard, len(episodes))
+            support, query = generator.get_episode_images(episodes[start:stop], n_support, rng)
+            images = np.concatenate((support, query), axis=1)
+            x = np.lib.format.open_memmap(join(self.folder, self.get_file_name('x', shard)), mode='w+',
+                                          dtype=dataset.x.dtype, shape=images.shape + dataset.x.shape[1:])
+            y = np.lib.format.open_memmap(join(self.folder, self.get_file_name('y', shard)), mode='w+',
+                                          dtype=dataset.y.dtype, shape=images.shape + dataset.y.shape[1:])
+            for i, episode_images in enumerate(images):
+                x[i] = dataset.x[episode_images]
+                y[i] = dataset.y[episode_images]
+            x.flush()
+            y.flush()
+            dp.save_array(images, self.folder, self.get_file_name('images', shard))
+            shards.append([start, stop])
+        self.metadata = {'n_support': int(n_support), 'episodes': episodes.tolist(), 'shards': shards,
+                         'source': generator.get_episode_source(n_support, self.seed)}
+        self.shards = {}
+        dp.save_json(self.metadata, self.folder, self.metadata_file_name)
+
+    def get_shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = tuple(
+                dp.load_array(self.folder, self.get_file_name(name, shard)) if name != 'x' or self.read_x else None
+                for name in ('images', 'x', 'y'))
+        return self.shards[shard]
+
+    def read(self, shard, start, stop):
+        '''
+        :param start: first episode relative to the shard
+        :return: {'images': episodes x (n_support + 1) image indexes, 'y': labels, 'x': images if read_x}, the query is
+        the last image of every episode
+        '''
+        images, x, y = self.get_shard(shard)
+        batch = {'images': np.array(images[start:stop]), 'y': np.array(y[start:stop])}
+        if self.read_x:
+            batch['x'] = np.array(x[start:stop])
+        return batch
+
+    def set_epoch(self, epoch):  # reshuffles the order of the shards and batches
+        self.epoch.fill_(epoch)
+
+    def __iter__(self):
+        '''
+        every loader worker reads its own shards, in an order that changes with set_epoch
+        '''
+        worker = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        rng = np.random.default_rng([self.seed, int(self.epoch)])
+        shards = rng.permutation(len(self.metadata['shards']))[worker_id::n_workers]
+        for shard in shards:
+            start, stop = self.metadata['shards'][shard]
+            batch_starts = rng.permutation(np.arange(0, stop - start, self.meta_batch_size))
+            for batch_start in batch_starts:
+                yield self.read(shard, batch_start, min(batch_start + self.meta_batch_size, stop - start))
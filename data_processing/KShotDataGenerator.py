@@ -1,56 +1,174 @@
+import json
 import data_processing.DataProcessor as dp
 from os.path import join, isfile
 import numpy as np
 import Model.Config as cfg
+from data_processing.EpisodeStore import EpisodeStore
+
+
+class LabelIndex():
+    def __init__(self, presence):
+        '''
+        inverted index from label to the (sorted) indexes of the images containing it
+        :param presence: n_images x n_labels, nonzero where the image contains the label
+        '''
+        self.presence = presence != 0
+        labels, image_indexes = np.nonzero(self.presence.T)  # sorted by label, then by image
+        self.offsets = np.searchsorted(labels, np.arange(self.presence.shape[1] + 1))
+        self.image_indexes = image_indexes
+
+    def get_labels(self, image_index):
+        return np.flatnonzero(self.presence[image_index])
+
+    def get_images(self, label):
+        return self.image_indexes[self.offsets[label]:self.offsets[label + 1]]
+
+    def sample_images(self, label, k, exclude=None, rng: np.random.Generator = None):
+        '''
+        k images containing label other than exclude, the first k in index order unless rng is given
+        '''
+        images = self.get_images(label)
+        n_candidates = min(k + 1, len(images))
+        if rng is not None:
+            images = images[rng.choice(len(images), size=n_candidates, replace=False)]
+        else:
+            images = images[:n_candidates]
+        return images[images != exclude][:k]
+
 
 class KShotSegmentationDataGenerator(dp.ProcessedDataSet):
-    def __init__(self, dataset: dp.ProcessedDataSet, n_samples=None, k=5):
+    def __init__(self, dataset: dp.ProcessedDataSet, n_samples=None, k=5, randomize=False, seed=24):
+        '''
+        the first n_samples images are the queries of the training episodes, every image of the dataset's test range is
+        the query of a test episode, support images are never taken from the test range
+        :param randomize: sample the k support images of each label at random (with seed) instead of taking the first k
+        '''
         super(KShotSegmentationDataGenerator, self).__init__('{}_{}-shot'.format(dataset.dataset_name, k))
         self.folder_path = '..\\Data\\MetaLearnerData\\'
         self.dataset = dataset
         if self.dataset.n_samples is None:
             raise ValueError('data is not loaded')
-        if n_samples is None:
-            self.n_samples = len(self.dataset.test_range)
+        self.n_samples = len(self.dataset.test_range) if n_samples is None else n_samples
 
         self.k = k
+        self.randomize = randomize
+        self.seed = seed
+        self.label_index = None
+        self.support_index = None
         self.meta_x_indeces = None
         self.meta_y_indeces = None
 
+    def try_load(self):
+        state = dp.load_object(cfg.processed_data_path, self.stored_file_name)
+        if state is None:
+            return False
+        self.__dict__.update(state)
+        return True
+
     def save(self):
         state = self.__dict__.copy()
         del state['dataset']
+        del state['label_index']  # derived from the dataset's pixel counts
+        del state['support_index']
         dp.save_object(state, cfg.processed_data_path, self.stored_file_name)
 
+    def get_label_index(self):  # built from the pixel count table stored with the dataset, y is not read
+        if self.label_index is None:
+            self.label_index = LabelIndex(self.dataset.get_label_presence())
+        return self.label_index
+
+    def get_support_index(self):  # the label index without the test range
+        if self.support_index is None:
+            presence = self.dataset.get_label_presence().copy()
+            presence[self.dataset.test_range.start:self.dataset.test_range.stop] = 0
+            self.support_index = LabelIndex(presence)
+        return self.support_index
+
     def create_meta_sets(self):  # c x h x w
         meta_x_indeces = []
         meta_y_indeces = []
-        trainee_x = self.dataset.x
-        trainee_y = self.dataset.y
-        for meta_idx in range(0, self.n_samples):
-
-            labels = np.unique(trainee_y[meta_idx], return_counts=False)
-            labels = labels[labels != self.dataset.ignore_index]
+        label_index = self.get_label_index()
+        support_index = self.get_support_index()
+        rng = np.random.default_rng(self.seed) if self.randomize else None
+        queries = list(range(0, self.n_samples))
+        queries += [meta_idx for meta_idx in self.dataset.test_range if meta_idx >= self.n_samples]
+        for meta_idx in queries:
             meta_y_indeces.append(meta_idx)
-
             meta_x = []
-            for label_idx in range(len(labels)):
-                label = labels[label_idx]
-                k = self.k
-                for data_idx in range(0, self.dataset.x.shape[0]):
-                    if data_idx != meta_idx:
-                        if k <= 0:
-                            break
-                        data_y = trainee_y[data_idx]
-                        if label in data_y:
-                            k -= 1
-                            meta_x.append(data_idx)
+            for label in label_index.get_labels(meta_idx):
+                meta_x.extend(support_index.sample_images(label, self.k, exclude=meta_idx, rng=rng).tolist())
             meta_x_indeces.append(meta_x)
         self.meta_x_indeces = meta_x_indeces
         self.meta_y_indeces = meta_y_indeces
-        print(np.shape(self.meta_x_indeces))
+        print('episodes: ', len(self.get_episode_indexes()), ' training, ', len(self.get_episode_indexes(test=True)),
+              ' test', **cfg.prnt)  # np.shape fails on the ragged support lists
+
+    def get_episode_indexes(self, test=False):
+        '''
+        :param test: the episodes whose query is in the dataset's test range instead of the training episodes
+        :return: the episodes with at least one support image
+        '''
+        return np.array([i for i, meta_x in enumerate(self.meta_x_indeces)
+                         if len(meta_x) > 0 and (self.meta_y_indeces[i] in self.dataset.test_range) == test],
+                        dtype=np.int64)
+
+    def sample_support(self, episode, n_support, rng: np.random.Generator = None):
+        '''
+        exactly n_support of the episode's support images so episodes can be stacked, the first n_support (repeated
+        if there are fewer) unless rng is given
+        '''
+        meta_x = np.asarray(self.meta_x_indeces[episode], dtype=np.int64)
+        if rng is not None:
+            return rng.choice(meta_x, size=n_support, replace=len(meta_x) < n_support)
+        return np.resize(meta_x, n_support)
+
+    def get_episode_images(self, episodes, n_support, rng: np.random.Generator = None):
+        '''
+        :return: image indexes of the support (n_episodes x n_support) and query (n_episodes x 1) images
+        '''
+        support = np.stack([self.sample_support(episode, n_support, rng) for episode in episodes])
+        query = np.array([[self.meta_y_indeces[episode]] for episode in episodes])
+        return support, query
+
+    def get_episodes(self, episodes, n_support, rng: np.random.Generator = None):
+        '''
+        stacked episodes cropped to the largest image among them
+        :return: support x, support y, query x, query y as n_episodes x n_support (1 for the query) x ... arrays
+        '''
+        support, query = self.get_episode_images(episodes, n_support, rng)
+        indexes = np.concatenate((support.ravel(), query.ravel()))
+        height, width = self.dataset.y.shape[-2:]
+        if self.dataset.sample_shapes is not None:
+            height, width = self.dataset.sample_shapes[indexes].max(axis=0)
+        x = self.dataset.x[indexes][..., :height, :width]
+        y = self.dataset.y[indexes][..., :height, :width]
+        n_episodes, n_support_images = support.shape[0], support.size
+        return (x[:n_support_images].reshape((n_episodes, n_support) + x.shape[1:]),
+                y[:n_support_images].reshape((n_episodes, n_support) + y.shape[1:]),
+                x[n_support_images:].reshape((n_episodes, 1) + x.shape[1:]),
+                y[n_support_images:].reshape((n_episodes, 1) + y.shape[1:]))
+
+    def get_episode_source(self, n_support, seed):
+        '''
+        :return: what an episode store is built from, the dataset's metadata (shapes, dtypes, downsample ratio, splits)
+        and the sampling of the support images, as it reads back from json
+        '''
+        return json.loads(json.dumps({'dataset': self.dataset.get_metadata(), 'k': self.k, 'randomize': self.randomize,
+                                      'n_support': int(n_support), 'seed': int(seed)}))
+
+    def get_episode_store(self, n_support, meta_batch_size=1, read_x=True):
+        '''
+        the episodes with n_support support images materialized next to the other stored arrays, built on first use
+        and rebuilt when the dataset or the sampling it was built from changed
+        '''
+        store = EpisodeStore(join(self.stored_folder_path, 'episodes_{}'.format(n_support)), meta_batch_size, read_x,
+                             self.seed)
+        if (not store.exists() or store.metadata.get('source') != self.get_episode_source(n_support, store.seed)
+                or sorted(store.metadata['episodes']) != self.get_episode_indexes().tolist()):
+            store.build(self, n_support)
+        return store
 
     def load_data(self):  # c x h x w
-        if not self.try_load():
+        if not self.try_load() or len(self.get_episode_indexes(test=True)) == 0:  # stored before test episodes
             self.create_meta_sets()
             self.save()
@@ -0,0 +1,83 @@
+import torch
+import numpy as np
+
+
+def random_seed():
+    return int(torch.empty((), dtype=torch.int64).random_().item())  # drawn from the global torch seed
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, buckets, batch_size, shuffle=True, seed=None, rank=0, world_size=1):
+        '''
+        yields batches of indexes that never mix shape buckets, so a batch can be cropped to the shape of its bucket
+        :param buckets: [start, stop, height, width] for each bucket, see ProcessedDataSet.get_buckets
+        :param rank: with world_size > 1 every rank yields its own share of the batches, all ranks need the same seed
+        '''
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.generator = torch.Generator()
+        self.generator.manual_seed(random_seed() if seed is None else seed)
+
+    def get_shape(self, indexes):
+        for start, stop, height, width in self.buckets:
+            if start <= indexes[0] < stop:
+                return height, width
+        raise IndexError('index {} is not in any bucket'.format(indexes[0]))
+
+    def get_batches(self):
+        batches = []
+        for start, stop, _, _ in self.buckets:
+            indexes = torch.arange(start, stop)
+            if self.shuffle:
+                indexes = indexes[torch.randperm(len(indexes), generator=self.generator)]
+            batches.extend(indexes[i:i + self.batch_size] for i in range(0, len(indexes), self.batch_size))
+        if self.shuffle:  # interleave the buckets
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator)]
+        return batches
+
+    def shard(self, batches):
+        '''
+        every rank takes the same number of batches, the largest batches are halved (so they stay in their bucket) until
+        the number of batches is a multiple of world_size, batches are only dropped if there are too few indexes
+        '''
+        batches = list(batches)
+        while len(batches) % self.world_size:
+            largest = max(range(len(batches)), key=lambda i: len(batches[i]))
+            if len(batches[largest]) < 2:
+                break
+            half = (len(batches[largest]) + 1) // 2
+            batches[largest:largest + 1] = [batches[largest][:half], batches[largest][half:]]
+        return batches[:len(batches) // self.world_size * self.world_size][self.rank::self.world_size]
+
+    def __iter__(self):
+        for batch in self.shard(self.get_batches()):
+            yield batch.tolist()
+
+    def __len__(self):
+        n_indexes = sum(stop - start for start, stop, _, _ in self.buckets)
+        n_batches = sum(int(np.ceil((stop - start) / self.batch_size)) for start, stop, _, _ in self.buckets)
+        return min(-(-n_batches // self.world_size), n_indexes // self.world_size)
+
+
+class WeightedBucketBatchSampler(BucketBatchSampler):
+    def __init__(self, buckets, batch_size, sample_weights, seed=None, rank=0, world_size=1):
+        '''
+        each epoch draws as many samples per bucket as the bucket holds, with replacement and proportionally to
+        sample_weights, so heavily weighted samples are seen several times per epoch and the epoch keeps its length
+        :param sample_weights: one weight per index, e.g. ProcessedDataSet.get_sample_weights
+        '''
+        super().__init__(buckets, batch_size, shuffle=True, seed=seed, rank=rank, world_size=world_size)
+        self.sample_weights = torch.as_tensor(np.asarray(sample_weights), dtype=torch.float64)
+
+    def get_batches(self):
+        batches = []
+        for start, stop, _, _ in self.buckets:
+            weights = self.sample_weights[start:stop]
+            if weights.sum() <= 0:
+                weights = torch.ones_like(weights)
+            indexes = start + torch.multinomial(weights, stop - start, replacement=True, generator=self.generator)
+            batches.extend(indexes[i:i + self.batch_size] for i in range(0, len(indexes), self.batch_size))
+        return [batches[i] for i in torch.randperm(len(batches), generator=self.generator)]
@@ -0,0 +1,11 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+# Config derives the experiment and data folders from the working directory, the tests keep them in a temporary one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+working_directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, working_directory, ignore_errors=True)
+os.chdir(working_directory)
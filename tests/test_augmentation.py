@@ -0,0 +1,61 @@
+import torch
+from data_processing.Augmentation import SegmentationAugmenter
+
+
+def get_batch(ignore_index=255, pad_label=255):
+    '''
+    two 3 channel 8 x 10 samples whose image is the top left 6 x 7, padded with -1 as ProcessedDataSet pads them, every
+    image has a column of ignored pixels inside it
+    '''
+    torch.manual_seed(0)
+    x = torch.full((2, 3, 8, 10), -1.)
+    x[:, :, :6, :7] = torch.rand(2, 3, 6, 7) * 2
+    y = torch.full((2, 8, 10), pad_label, dtype=torch.long)
+    y[:, :6, :7] = torch.randint(0, 3, (2, 6, 7))
+    y[:, :6, 3] = ignore_index
+    return x, y, torch.tensor([[6, 7], [6, 7]])
+
+
+def test_jitter_covers_ignored_pixels_inside_the_image():
+    x, y, shapes = get_batch()
+    augmenter = SegmentationAugmenter(ignore_index=255, flip=0., scale_range=(1., 1.))
+    x_out, y_out = augmenter(x.clone(), y.clone(), shapes)
+    assert torch.equal(y_out, y)
+    assert torch.all(x_out[:, :, 6:, :] == -1) and torch.all(x_out[:, :, :, 7:] == -1)
+    inside = x_out[:, :, :6, :7]
+    # the ignored column is jittered with the rest of the image, gain and contrast are one affine map per sample
+    for i in range(2):
+        scale = (inside[i] - inside[i].mean()) / (x[i, :, :6, :7] - x[i, :, :6, :7].mean())
+        assert torch.allclose(scale, scale.flatten()[0].expand_as(scale), atol=1e-4)
+
+
+def test_jitter_mean_excludes_padding():
+    x, y, shapes = get_batch()
+    augmenter = SegmentationAugmenter(ignore_index=255, flip=0., scale_range=(1., 1.), brightness=0.)
+    x_out, _ = augmenter(x.clone(), y.clone(), shapes)
+    assert torch.allclose(x_out[:, :, :6, :7].mean(dim=(1, 2, 3)), x[:, :, :6, :7].mean(dim=(1, 2, 3)), atol=1e-5)
+
+
+def test_padding_with_a_valid_label_is_not_jittered():  # BSR pads labels with 0 and ignores -1
+    x, y, shapes = get_batch(ignore_index=-1, pad_label=0)
+    augmenter = SegmentationAugmenter(ignore_index=-1, flip=1., scale_range=(1., 1.))
+    x_out, _ = augmenter(x.clone(), y.clone(), shapes)
+    assert torch.all(x_out[:, :, 6:, :] == -1) and torch.all(x_out[:, :, :, :3] == -1)
+
+
+def test_scaled_padding_keeps_its_value():
+    x, y, shapes = get_batch()
+    augmenter = SegmentationAugmenter(ignore_index=255, scale_range=(.5, .5))
+    x_out, _ = augmenter(x.clone(), y.clone(), shapes)
+    # halving the 8 x 10 batch samples rows 0, 2, 4 and columns 0, 2, 4, 6 of the 6 x 7 image, the rest is padding
+    assert torch.equal((x_out != -1).all(dim=1).sum(dim=(1, 2)), torch.tensor([12, 12]))
+    assert torch.all((x_out == -1).all(dim=1) | (x_out != -1).all(dim=1))
+
+
+def test_black_pixels_inside_the_image_are_jittered():  # black normalizes to the padding value in every channel
+    x, y, shapes = get_batch()
+    x[:, :, 2:4, 1:5] = -1
+    augmenter = SegmentationAugmenter(ignore_index=255, flip=0., scale_range=(1., 1.), brightness=0.)
+    x_out, _ = augmenter(x.clone(), y.clone(), shapes)
+    assert torch.all(x_out[:, :, 6:, :] == -1) and torch.all(x_out[:, :, :, 7:] == -1)
+    assert not torch.any(x_out[:, :, 2:4, 1:5] == -1)
@@ -0,0 +1,70 @@
+import os
+import random
+import numpy as np
+import pytest
+import torch
+import Model.Config as cfg
+import Model.SegmentationModel as sm
+import data_processing.DataProcessor as dp
+from Model.Checkpoint import Checkpointer
+
+
+class TinyDataSet(dp.ProcessedDataSet):
+    def __init__(self):
+        super(TinyDataSet, self).__init__('Tiny', np.float32, np.int32)
+
+    def load_data(self):  # 20 random 3 x 16 x 16 images and their labels, kept in memory
+        rng = np.random.default_rng(0)
+        self.n_samples = 20
+        self.x = rng.standard_normal((self.n_samples, 3, 16, 16)).astype(np.float32)
+        self.y = rng.integers(0, 3, (self.n_samples, 16, 16)).astype(np.int32)
+        self.x_shape = self.x.shape
+        self.set_data_split(12, 16)
+        self.pixel_counts = dp.count_labels(self.y, 3)
+        self.calc_class_weights_from_counts()
+        self.n_classes = len(self.class_weights)
+
+
+def train(epochs, resume=False, seed=0):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    segmenter = sm.Segmenter(lr=.01, model_size=8, encoding_size=16, data=TinyDataSet())
+    segmenter.train(epochs=epochs, batch_size=4, checkpoint_space=1, resume=resume)
+    return segmenter
+
+
+@pytest.mark.parametrize('loader_workers', [0, 1])
+def test_resumed_training_matches_uninterrupted_training(tmp_path, monkeypatch, loader_workers):
+    monkeypatch.setattr(cfg, 'checkpoint_every', 1)
+    monkeypatch.setattr(cfg, 'loader_workers', loader_workers)
+    monkeypatch.setattr(cfg, 'checkpoint_path', str(tmp_path / 'uninterrupted'))
+    uninterrupted = train(2)
+    monkeypatch.setattr(cfg, 'checkpoint_path', str(tmp_path / 'resumed'))
+    train(1)
+    resumed = train(2, resume=True, seed=1)  # the weights and every random state come from the checkpoint
+    expected, actual = uninterrupted.model.state_dict(), resumed.model.state_dict()
+    assert expected.keys() == actual.keys()
+    assert all(torch.equal(expected[name], actual[name]) for name in expected)
+    assert uninterrupted.history == resumed.history
+
+
+def test_checkpointer_keeps_the_most_recent(tmp_path):
+    checkpointer = Checkpointer(str(tmp_path), keep=2)
+    for epoch in range(4):
+        checkpointer.save({'epoch': epoch, 'weights': torch.full((3,), float(epoch))}, epoch)
+    checkpointer.wait()
+    assert sorted(os.listdir(tmp_path)) == ['checkpoint_2.pt', 'checkpoint_3.pt']  # no .tmp file is left behind
+    state = checkpointer.load_latest()
+    assert state['epoch'] == 3 and torch.equal(state['weights'], torch.full((3,), 3.))
+    checkpointer.close()
+
+
+def test_interrupted_write_is_not_loaded(tmp_path):
+    checkpointer = Checkpointer(str(tmp_path))
+    checkpointer.save({'epoch': 0}, 0)
+    checkpointer.wait()
+    (tmp_path / 'checkpoint_1.pt.tmp').write_bytes(b'half a checkpoint')
+    assert checkpointer.get_epochs() == [0]
+    assert checkpointer.load_latest() == {'epoch': 0}
+    checkpointer.close()
@@ -0,0 +1,26 @@
+import numpy as np
+import data_processing.DataProcessor as dp
+from data_processing.KShotDataGenerator import KShotSegmentationDataGenerator
+
+
+def get_dataset(n_samples=20, n_labels=4):
+    '''
+    a dataset of n_samples images whose pixel counts are all that is stored, the last 4 images are its test range
+    '''
+    dataset = dp.ProcessedDataSet('KShotTest')
+    dataset.n_samples = n_samples
+    dataset.pixel_counts = np.random.default_rng(0).integers(0, 3, (n_samples, n_labels))
+    dataset.set_data_split(12, 16)
+    return dataset
+
+
+def test_test_episodes_are_held_out():
+    dataset = get_dataset()
+    generator = KShotSegmentationDataGenerator(dataset, k=2, randomize=True)
+    generator.create_meta_sets()
+    train, test = generator.get_episode_indexes(), generator.get_episode_indexes(test=True)
+    assert len(train) > 0 and len(test) > 0
+    assert all(generator.meta_y_indeces[episode] not in dataset.test_range for episode in train)
+    assert all(generator.meta_y_indeces[episode] in dataset.test_range for episode in test)
+    # no episode, training or test, is supported by a test image
+    assert all(image not in dataset.test_range for meta_x in generator.meta_x_indeces for image in meta_x)
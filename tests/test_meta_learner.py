@@ -0,0 +1,7 @@
+import pytest
+from Model.MetaLearningModel import MetaLearner
+
+
+def test_no_inner_steps_is_rejected():
+    with pytest.raises(ValueError):
+        MetaLearner(None, inner_steps=0)
@@ -0,0 +1,75 @@
+import numpy as np
+import torch
+from sklearn.metrics import confusion_matrix
+import Model.Config as cfg
+from Model.Utilities import ConfusionMatrix
+from Model.SegmentationModel import SegmentationModel
+from Model.Inference import InferenceEngine
+
+
+def get_labels(n_class, shape=(4, 12, 9), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, n_class, shape), rng.integers(0, n_class, shape)
+
+
+def test_matches_sklearn():
+    predictions, ground_truths = get_labels(5)
+    metrics = ConfusionMatrix(5, device='cpu')
+    for i in range(len(predictions)):  # accumulated batch by batch
+        metrics.update(torch.from_numpy(predictions[i:i + 1]), torch.from_numpy(ground_truths[i:i + 1]))
+    expected = confusion_matrix(ground_truths.ravel(), predictions.ravel(), labels=range(5))
+    assert np.array_equal(metrics.get_matrix(), expected)
+    assert np.isclose(metrics.pixel_accuracy(), np.mean(predictions == ground_truths))
+
+
+def test_ignore_index_is_skipped():  # as VOC, whose ignored label 255 lies outside of the classes
+    predictions, ground_truths = get_labels(4)
+    ground_truths[:, :3] = 255
+    ground_truths[:, :, 0] = 2
+    metrics = ConfusionMatrix(4, ignore_index=2, device='cpu')
+    metrics.update(predictions, ground_truths)
+    kept = (ground_truths != 2) & (ground_truths != 255)
+    expected = confusion_matrix(ground_truths[kept], predictions[kept], labels=range(4))
+    assert np.array_equal(metrics.get_matrix(), expected)
+    assert metrics.get_matrix()[2].sum() == 0
+
+
+def test_out_of_range_labels_and_predictions_are_skipped():  # e.g. BSR's ignore_index -1 and a 255 fill value
+    predictions, ground_truths = get_labels(3)
+    ground_truths[0] = -1
+    predictions[1, :5] = 255
+    ground_truths[2, :, :4] = 7
+    metrics = ConfusionMatrix(3, ignore_index=-1, device='cpu')
+    metrics.update(predictions, ground_truths)
+    kept = (ground_truths >= 0) & (ground_truths < 3) & (predictions < 3)
+    expected = confusion_matrix(ground_truths[kept], predictions[kept], labels=range(3))
+    assert np.array_equal(metrics.get_matrix(), expected)
+    assert metrics.get_matrix().sum() == kept.sum()
+
+
+def test_iou_of_absent_classes_is_nan():
+    metrics = ConfusionMatrix(3, device='cpu')
+    metrics.update(np.array([0, 0, 1, 1]), np.array([0, 1, 1, 1]))
+    iou = metrics.iou()
+    assert np.allclose(iou[:2], [1 / 2, 2 / 3]) and np.isnan(iou[2])
+    assert np.isclose(metrics.mean_iou(), (1 / 2 + 2 / 3) / 2)
+
+
+def test_padding_outside_the_images_is_not_counted():  # BSR pads its labels with the real class 0
+    torch.manual_seed(0)
+    model = SegmentationModel((1, 3, 16, 16), 3, (16, 16), size=8, encoding_size=16).to(**cfg.args)
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((5, 3, 16, 16)).astype(np.float32)
+    y = rng.integers(0, 3, (5, 16, 16))
+    shapes = np.array([[16, 16], [10, 12], [16, 5], [3, 3], [12, 16]])
+    for label, (height, width) in zip(y, shapes):
+        label[height:], label[:, width:] = 0, 0
+    engine = InferenceEngine(model, max_batch_size=2)
+    metrics = engine.evaluate(x, y, ConfusionMatrix(3, ignore_index=-1), shapes=shapes)
+    predictions = engine.predict(x)
+    inside = [(prediction[:height, :width].ravel(), label[:height, :width].ravel())
+              for prediction, label, (height, width) in zip(predictions, y, shapes)]
+    expected = confusion_matrix(np.concatenate([label for _, label in inside]),
+                                np.concatenate([prediction for prediction, _ in inside]), labels=range(3))
+    assert np.array_equal(metrics.get_matrix(), expected)
+    assert metrics.get_matrix().sum() == sum(height * width for height, width in shapes)
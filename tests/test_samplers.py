@@ -0,0 +1,43 @@
+import pytest
+from data_processing.Samplers import BucketBatchSampler, WeightedBucketBatchSampler
+
+BUCKETS = [[0, 7, 8, 8], [7, 20, 8, 12], [20, 23, 16, 12], [23, 41, 16, 16]]
+
+
+def get_bucket(index):
+    return next(i for i, (start, stop, _, _) in enumerate(BUCKETS) if start <= index < stop)
+
+
+def get_rank_batches(sampler_class, world_size, epoch_seed=0, **kwargs):
+    '''
+    :return: the batches of every rank, the samplers of all ranks share their seed as Segmenter.train's do
+    '''
+    return [list(sampler_class(BUCKETS, 4, seed=epoch_seed, rank=rank, world_size=world_size, **kwargs))
+            for rank in range(world_size)]
+
+
+@pytest.mark.parametrize('world_size', [1, 2, 3, 4, 5])
+def test_every_index_once_per_epoch_across_ranks(world_size):
+    rank_batches = get_rank_batches(BucketBatchSampler, world_size)
+    indexes = sorted(index for batches in rank_batches for batch in batches for index in batch)
+    assert indexes == list(range(41))
+    assert len({len(batches) for batches in rank_batches}) == 1  # every rank steps as often
+    assert len(rank_batches[0]) == len(BucketBatchSampler(BUCKETS, 4, rank=0, world_size=world_size))
+
+
+@pytest.mark.parametrize('world_size', [1, 3])
+def test_batches_stay_in_one_bucket(world_size):
+    samplers = ((BucketBatchSampler, {}), (WeightedBucketBatchSampler, {'sample_weights': range(41)}))
+    for sampler_class, kwargs in samplers:
+        for batches in get_rank_batches(sampler_class, world_size, **kwargs):
+            for batch in batches:
+                assert 0 < len(batch) <= 4 and len({get_bucket(index) for index in batch}) == 1
+
+
+def test_weighted_draws_are_shared_out_without_repeats():  # the draws are with replacement, the shards are not
+    weights = [1. + index % 3 for index in range(41)]
+    drawn = sorted(int(index) for batch in WeightedBucketBatchSampler(BUCKETS, 4, weights, seed=0).get_batches()
+                   for index in batch)
+    rank_batches = get_rank_batches(WeightedBucketBatchSampler, 3, sample_weights=weights)
+    assert sorted(index for batches in rank_batches for batch in batches for index in batch) == drawn
+    assert len({len(batches) for batches in rank_batches}) == 1
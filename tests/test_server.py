@@ -0,0 +1,28 @@
+import asyncio
+import numpy as np
+import pytest
+import torch
+from Model.SegmentationModel import SegmentationModel
+from Model.Server import Batcher
+
+
+def get_model():
+    torch.manual_seed(0)
+    return SegmentationModel((1, 3, 16, 16), 3, (16, 16), size=8, encoding_size=16)
+
+
+@pytest.mark.parametrize('image', [np.zeros((4, 16, 16), np.float32), np.zeros((3, 16, 16), np.int64),
+                                   np.zeros((16, 16), np.float32), np.zeros((3, 0, 16), np.float32)])
+def test_bad_image_fails_alone(image):
+    async def run():
+        batcher = Batcher(get_model(), max_batch_size=4, latency_budget=.05)
+        task = asyncio.get_running_loop().create_task(batcher.run())
+        good = np.random.default_rng(0).standard_normal((3, 16, 12)).astype(np.float32)
+        results = await asyncio.gather(batcher.predict(good), batcher.predict(image), batcher.predict(good),
+                                       return_exceptions=True)
+        task.cancel()
+        return results
+
+    first, bad, second = asyncio.run(run())
+    assert isinstance(bad, ValueError)
+    assert first.shape == second.shape == (16, 12)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from Model.Inference import TiledInference
+
+
+class PixelModel(nn.Module):
+    def __init__(self, n_class=5, max_size=64):
+        '''
+        logits of every pixel from its own channels plus a bias that depends on where the pixel lies in its tile, so
+        the tiles covering a pixel disagree and the blending decides its label
+        '''
+        super(PixelModel, self).__init__()
+        torch.manual_seed(0)
+        self.decoder = nn.Module()
+        self.decoder.l2 = nn.Sequential(nn.Conv2d(3, n_class, 1))
+        self.register_buffer('bias', 2 * torch.randn(n_class, max_size, max_size))
+
+    def forward(self, x, out_shape=None):
+        logits = F.interpolate(self.decoder.l2(x), out_shape, mode='nearest')
+        return logits + self.bias[:, :out_shape[0], :out_shape[1]]
+
+
+def blend_on_canvas(tiled, image):  # every tile's weighted probabilities added up on a full size canvas
+    height, width = image.shape[-2:]
+    tile_height, tile_width = min(tiled.tile_size, height), min(tiled.tile_size, width)
+    canvas = torch.zeros(tiled.n_class, height, width)
+    with torch.inference_mode():
+        for row in tiled.get_starts(height, tile_height):
+            for column in tiled.get_starts(width, tile_width):
+                tile = image[None, :, row:row + tile_height, column:column + tile_width]
+                canvas[:, row:row + tile_height, column:column + tile_width] += tiled.predict_tiles(tile)[0]
+    return canvas.argmax(dim=0).numpy()
+
+
+@pytest.mark.parametrize('height, width, tile_size, overlap, batch_size, downsample_ratio', [
+    (100, 130, 32, 8, 3, 1),
+    (77, 51, 24, 0, 1, 1),
+    (64, 200, 40, 20, 5, 2),
+    (45, 45, 16, 15, 2, 1),
+    (30, 20, 64, 8, 2, 2),  # a single tile smaller than tile_size
+])
+def test_matches_blending_on_a_full_canvas(height, width, tile_size, overlap, batch_size, downsample_ratio):
+    model = PixelModel().eval()
+    image = np.random.default_rng(height).standard_normal((3, height, width)).astype(np.float32)
+    tiled = TiledInference(model, tile_size, overlap, downsample_ratio, batch_size)
+    labels = tiled.predict(image)
+    assert labels.shape == (height, width) and labels.dtype == np.uint8
+    assert np.array_equal(labels, blend_on_canvas(tiled, image))
+
+
+def test_overlap_must_be_smaller_than_the_tile():
+    with pytest.raises(ValueError):
+        TiledInference(PixelModel(), tile_size=16, overlap=16)